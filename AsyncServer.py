@@ -0,0 +1,278 @@
+import sys
+import json
+import time
+import asyncio
+import threading
+import concurrent.futures
+import Metrics
+import Utils
+from Server import (Server, HOST, PORT, HANDSHAKE_WORKERS, HANDSHAKE_QUEUE, KEY_EXCHANGE_TIMEOUT,
+                    LOGIN_TIMEOUT)
+
+EXECUTOR_WORKERS = 8    # threads for bcrypt, RSA, JPEG decode and lobby requests
+SEND_TIMEOUT = 10       # seconds a room thread waits for the event loop to take a frame
+
+
+class AsyncPeer:
+    """
+    One client connection on the event loop. Coroutines use recv()/send(); GameRoom and
+    Server keep treating it as a socket: sendall() may be called from any thread and
+    hands the bytes to the loop, so Utils.send_encrypted works on it unchanged.
+    Everything this server itself sends is sealed and written on the loop thread, which
+    keeps session nonces in order without anyone waiting on the socket lock.
+    """
+
+    def __init__(self, loop, reader, writer):
+        self.loop = loop
+        self.reader = reader
+        self.writer = writer
+        self.loop_thread = threading.get_ident()
+        self.closed = False
+
+    async def read_exactly(self, n):
+        try:
+            return await self.reader.readexactly(n)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Socket closed")
+
+    async def recv(self, aes_key):
+        # Same framing as Utils.recv_encrypted: 4-byte length, then nonce | ciphertext | tag
+        length = int.from_bytes(await self.read_exactly(4), "big")
+        return Utils.aes_decrypt(aes_key, await self.read_exactly(length))
+
+    async def write(self, data):
+        if self.closed:
+            raise ConnectionResetError("Connection closed")
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def send(self, aes_key, plaintext):
+        # On the loop thread sendall() only buffers, the lock is never held across a wait
+        Utils.send_encrypted(self, aes_key, plaintext)
+        await self.writer.drain()
+
+    def outbox(self, aes_key, max_frames, observe=None):
+        # GameRoom asks the connection for its Outbox, ours drains on the loop
+        return AsyncOutbox(self, aes_key, max_frames, observe)
+
+    def sendall(self, data):
+        if threading.get_ident() == self.loop_thread:
+            if self.closed:
+                raise ConnectionResetError("Connection closed")
+            self.writer.write(data)
+            return
+        future = asyncio.run_coroutine_threadsafe(self.write(data), self.loop)
+        try:
+            future.result(SEND_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError("Client is not reading")
+
+    async def wait_closed(self):
+        # Discard anything else the client sends until it hangs up
+        while await self.reader.read(65536):
+            pass
+
+    def close(self):
+        if threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(self.close)
+            return
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+
+class AsyncOutbox(Utils.Outbox):
+    """
+    Utils.Outbox for an AsyncPeer: the same queue and drop policy, drained by a task on
+    the peer's event loop instead of a writer thread per connection.
+    """
+
+    def __init__(self, peer, aes_key, max_frames=2, observe=None):
+        self.peer = peer
+        self.ready = asyncio.Event()
+        super().__init__(peer, aes_key, max_frames, observe)
+
+    def start(self):
+        # Rooms are joined from the executor, so the task is handed to the loop
+        self.writer = asyncio.run_coroutine_threadsafe(self.drain(), self.peer.loop)
+
+    def wake(self):
+        self.peer.loop.call_soon_threadsafe(self.ready.set)
+
+    async def drain(self):
+        while True:
+            plaintext = self.take()
+            if plaintext is None:
+                if self.closed:
+                    return
+                await self.ready.wait()
+                self.ready.clear()
+                continue
+            start = time.perf_counter()
+            try:
+                self.frame_writer.write(plaintext)
+                await asyncio.wait_for(self.peer.writer.drain(), SEND_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as e:
+                self.failed(e)
+                return
+            self.wrote(time.perf_counter() - start)
+
+    def join(self, timeout=None):
+        try:
+            self.writer.result(timeout)
+        except concurrent.futures.TimeoutError:
+            pass
+
+
+class AsyncServer:
+    """
+    The connection side of Server on asyncio: one task per client instead of one
+    thread, with the same handshake, login and lobby messages, so GUI.py clients
+    connect unchanged. Blocking work (RSA, bcrypt, sqlite, decoding uploads) runs in a
+    thread pool; rooms keep their own game loop and pipeline threads.
+    python Server.py runs this core unless Server.ASYNC_CORE is False.
+    """
+
+    def __init__(self, server=None, workers=EXECUTOR_WORKERS):
+        self.server = server if server is not None else Server()
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="async-server")
+        self.loop = None
+        self.handshake_slots = None   # same limits as the threaded core's handshake workers and queue
+
+    def offload(self, fn, *args):
+        return self.loop.run_in_executor(self.executor, fn, *args)
+
+    async def run(self, host=HOST, port=PORT):
+        self.loop = asyncio.get_running_loop()
+        self.handshake_slots = asyncio.Semaphore(HANDSHAKE_WORKERS)
+        srv = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"[AsyncServer] listening on {port}")
+        async with srv:
+            await srv.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        peer = AsyncPeer(self.loop, reader, writer)
+        addr = writer.get_extra_info("peername")
+        print(f"[AsyncServer] Connection from {addr}")
+        try:
+            session = await self.setup(peer, addr)
+            if session is None:
+                return
+            user, aes_key = session
+            self.server.sessions[user] = aes_key
+            self.server.users[user] = peer
+            await self.serve_requests(user, peer, aes_key)
+        except (ConnectionError, OSError) as e:
+            print(f"[AsyncServer] Connection lost for {addr}:", e)
+        except Exception as e:
+            print(f"[AsyncServer] unexpected error for {addr}:", e)
+        finally:
+            peer.close()
+
+    async def setup(self, peer, addr):
+        """
+        Key exchange and login under the threaded core's limits, timeouts and metrics:
+        at most HANDSHAKE_WORKERS at once, HANDSHAKE_QUEUE more waiting, the rest refused.
+        Returns (user, aes_key), or None once the connection should be closed.
+        """
+        server = self.server
+        accepted = time.perf_counter()
+        if self.handshake_slots.locked() and server.handshakes_waiting >= HANDSHAKE_QUEUE:
+            print(f"[AsyncServer] Handshake queue full, refusing {addr}")
+            Metrics.handshakes.inc('refused')
+            return None
+        server.handshakes_waiting += 1
+        try:
+            await self.handshake_slots.acquire()
+        finally:
+            server.handshakes_waiting -= 1
+        start = time.perf_counter()
+        Metrics.handshake_seconds.observe(start - accepted, 'queued')
+        with server.handshake_lock:
+            server.handshakes_busy += 1
+        try:
+            aes_key = await self.handshake(peer)
+            exchanged = time.perf_counter()
+            Metrics.handshake_seconds.observe(exchanged - start, 'key_exchange')
+            user = await self.login(peer, aes_key)
+            Metrics.handshake_seconds.observe(time.perf_counter() - exchanged, 'login')
+        except Exception as e:
+            # Timeouts, resets and garbage from the client all end the same way
+            print(f"[AsyncServer] Handshake with {addr} failed: {e!r}")
+            Metrics.handshakes.inc('failed')
+            return None
+        finally:
+            with server.handshake_lock:
+                server.handshakes_busy -= 1
+            self.handshake_slots.release()
+
+        if user is None:
+            Metrics.handshakes.inc('rejected')
+            print(f"[AsyncServer] Authentication failed for {addr}. Socket closed.")
+            return None
+        Metrics.handshakes.inc('ok')
+        print(f"[AsyncServer] {user} authenticated, AES key established "
+              f"(key exchange {(exchanged - start) * 1000:.0f} ms, queued {(start - accepted) * 1000:.0f} ms, "
+              f"{server.handshakes_waiting} waiting).")
+        return user, aes_key
+
+    async def handshake(self, peer):
+        # Server's RSA public key out, the client's RSA-encrypted AES key back
+        pub_der = self.server.server_public.export_key(format='DER')
+        await peer.write(len(pub_der).to_bytes(4, "big") + pub_der)
+        length = int.from_bytes(await asyncio.wait_for(peer.read_exactly(4), KEY_EXCHANGE_TIMEOUT), "big")
+        enc_aes_key = await asyncio.wait_for(peer.read_exactly(length), KEY_EXCHANGE_TIMEOUT)
+        aes_key = await self.offload(Utils.rsa_decrypt, self.server.server_private, enc_aes_key)
+        return Utils.CryptoSession(aes_key, server=True)
+
+    async def login(self, peer, aes_key):
+        for _ in range(3):
+            # The user is typing, but a client that never answers does not hold a slot forever
+            msg = json.loads(await asyncio.wait_for(peer.recv(aes_key), LOGIN_TIMEOUT))
+            username, reply = await self.offload(self.server.authenticate, msg)
+            await peer.send(aes_key, json.dumps(reply).encode())
+            if reply["ok"]:
+                return username
+        return None
+
+    async def serve_requests(self, user, peer, aes_key):
+        while True:
+            msg = json.loads(await peer.recv(aes_key))
+            reply, done = await self.offload(self.server.dispatch, user, peer, aes_key, msg, False)
+            await peer.send(aes_key, json.dumps(reply).encode())
+            if msg.get("action") == "exit":
+                return
+            if done:
+                break
+
+        room = None
+        if reply.get("ok"):
+            room = self.server.gameRooms.get(reply.get("room_id", msg.get("room_id")))
+        if room is not None and msg.get("role") == "player":
+            await self.serve_uploads(room, user, peer, aes_key)
+        # Players and spectators stay connected for the final result
+        await peer.wait_closed()
+
+    async def serve_uploads(self, room, user, peer, aes_key):
+        # GameRoom.recv_loop on the event loop; decoding happens in the pool, in order
+        try:
+            active = True
+            while active and room.winner is None:
+                plaintext = await peer.recv(aes_key)
+                active = await self.offload(room.handle_upload, user, plaintext)
+        finally:
+            # The room lock can be held by the game loop for a whole tick
+            self.executor.submit(room.player_left, user)
+
+
+def main():
+    try:
+        asyncio.run(AsyncServer().run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
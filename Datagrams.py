@@ -0,0 +1,161 @@
+import os
+import struct
+import threading
+from Crypto.Cipher import AES
+import Utils
+
+PAYLOAD_SIZE = 1200     # frame bytes per datagram, fits an internet path MTU with our headers
+CHANNEL_SIZE = 8        # random id the server hands out over TCP, names the sender of a datagram
+MAX_PENDING = 4         # partly received frames kept while waiting for their missing fragments
+REPLAY_WINDOW = 64      # datagram counters this far behind the newest are still accepted
+# Same session key as the TCP connection, so datagram nonces get their own direction prefixes
+SERVER = b"\x00\x00\x01\x01"
+CLIENT = b"\x00\x00\x01\x02"
+# Inside the encryption: frame number, fragment index, fragment count
+FRAGMENT_HEADER = struct.Struct(">IHH")
+OVERHEAD = CHANNEL_SIZE + Utils.AES_NONCE_SIZE + FRAGMENT_HEADER.size + Utils.AES_TAG_SIZE
+
+#
+# Video frames over UDP. A frame is split into fragments of at most PAYLOAD_SIZE bytes,
+# each sealed on its own: channel | nonce | AES-GCM(fragment header | bytes) | tag, with
+# the channel as associated data. There are no retransmissions: a frame that is still
+# missing fragments when a newer one completes is dropped, and so is anything older
+# than the last frame delivered.
+#
+
+
+def new_channel():
+    return os.urandom(CHANNEL_SIZE)
+
+
+class DatagramSender:
+    """
+    Fragments and seals frames onto a connected UDP socket. aes_key may be a
+    CryptoSession, only its key is used: the TCP connection keeps its own counters.
+    """
+
+    def __init__(self, sock, aes_key, channel, server=False, payload_size=PAYLOAD_SIZE):
+        self.sock = sock
+        self.key = aes_key.key if isinstance(aes_key, Utils.CryptoSession) else bytes(aes_key)
+        self.channel = bytes(channel)
+        self.prefix = SERVER if server else CLIENT
+        self.payload_size = payload_size
+        self.frame = 0
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def send(self, plaintext):
+        view = memoryview(plaintext)
+        count = max(1, -(-len(view) // self.payload_size))
+        if count > 0xFFFF:
+            raise ValueError(f"Frame of {len(view)} bytes is too large for datagrams")
+        with self.lock:
+            self.frame = (self.frame + 1) & 0xFFFFFFFF
+            for index in range(count):
+                self.counter += 1
+                nonce = self.prefix + self.counter.to_bytes(8, "big")
+                cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+                cipher.update(self.channel)
+                chunk = view[index * self.payload_size:(index + 1) * self.payload_size]
+                ciphertext = cipher.encrypt(FRAGMENT_HEADER.pack(self.frame, index, count))
+                ciphertext += cipher.encrypt(chunk)
+                self.sock.send(b"".join((self.channel, nonce, ciphertext, cipher.digest())))
+        return count
+
+
+class ReplayWindow:
+    # Sliding bitmap over datagram counters, reordering within the window is fine
+    def __init__(self, size=REPLAY_WINDOW):
+        self.size = size
+        self.highest = 0
+        self.seen = 0
+
+    def check(self, counter):
+        if counter > self.highest:
+            return True
+        behind = self.highest - counter
+        return behind < self.size and not self.seen >> behind & 1
+
+    def accept(self, counter):
+        if counter > self.highest:
+            self.seen = (self.seen << (counter - self.highest) | 1) & ((1 << self.size) - 1)
+            self.highest = counter
+        else:
+            self.seen |= 1 << (self.highest - counter)
+
+
+class DatagramReceiver:
+    """
+    Verifies and reassembles the datagrams of one channel. feed() takes one datagram
+    and returns a complete frame when it was the last missing piece of one that is
+    newer than anything delivered so far, else None. Datagrams that fail to verify are
+    counted and ignored, never raised: anyone can send to a UDP port.
+    """
+
+    def __init__(self, aes_key, channel, server=True, max_pending=MAX_PENDING):
+        self.key = aes_key.key if isinstance(aes_key, Utils.CryptoSession) else bytes(aes_key)
+        self.channel = bytes(channel)
+        self.prefix = CLIENT if server else SERVER
+        self.max_pending = max_pending
+        self.replay = ReplayWindow()
+        self.pending = {}     # frame -> [fragments by index, fragments received]
+        self.delivered = 0    # last frame handed out
+        self.frames = 0
+        self.late = 0         # fragments of frames already delivered or given up on
+        self.incomplete = 0   # frames dropped with fragments missing
+        self.rejected = 0     # datagrams that failed to verify or were replayed
+
+    def open(self, datagram):
+        # -> (frame, index, count, bytes), or None when it does not verify
+        datagram = memoryview(datagram)
+        if len(datagram) < OVERHEAD or datagram[:CHANNEL_SIZE] != self.channel:
+            return None
+        nonce = datagram[CHANNEL_SIZE:CHANNEL_SIZE + Utils.AES_NONCE_SIZE]
+        counter = int.from_bytes(nonce[4:], "big")
+        if nonce[:4] != self.prefix or not self.replay.check(counter):
+            return None
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=bytes(nonce))
+        cipher.update(self.channel)
+        try:
+            plaintext = cipher.decrypt_and_verify(datagram[CHANNEL_SIZE + Utils.AES_NONCE_SIZE:-Utils.AES_TAG_SIZE],
+                                                  datagram[-Utils.AES_TAG_SIZE:])
+        except ValueError:
+            return None
+        self.replay.accept(counter)
+        frame, index, count = FRAGMENT_HEADER.unpack_from(plaintext)
+        return frame, index, count, plaintext[FRAGMENT_HEADER.size:]
+
+    def feed(self, datagram):
+        opened = self.open(datagram)
+        if opened is None:
+            self.rejected += 1
+            return None
+        frame, index, count, data = opened
+        if frame <= self.delivered or index >= count:
+            self.late += 1
+            return None
+        entry = self.pending.get(frame)
+        if entry is None:
+            if len(self.pending) >= self.max_pending:
+                # Give up on the oldest frame still waiting
+                del self.pending[min(self.pending)]
+                self.incomplete += 1
+            entry = self.pending[frame] = [[None] * count, 0]
+        fragments = entry[0]
+        if len(fragments) != count or fragments[index] is not None:
+            return None
+        fragments[index] = data
+        entry[1] += 1
+        if entry[1] < count:
+            return None
+        # Complete: anything older still waiting can only arrive late now
+        for older in [f for f in self.pending if f <= frame]:
+            self.incomplete += older != frame
+            del self.pending[older]
+        self.delivered = frame
+        self.frames += 1
+        return b"".join(fragments)
+
+    def stats(self):
+        return {'frames': self.frames, 'late': self.late, 'incomplete': self.incomplete,
+                'rejected': self.rejected, 'pending': len(self.pending)}
@@ -0,0 +1,496 @@
+import os
+import sys
+import argparse
+import threading
+import queue
+import time
+import cv2
+import numpy as np
+
+DEFAULT_BACKEND = "ultralytics"
+DEFAULT_WEIGHTS = "yolov8n.pt"
+PERSON_CLASS = 0
+MIN_CONFIDENCE = 0.5
+NMS_IOU = 0.7           # same default as ultralytics
+INPUT_SIZE = 640        # square network input, frames are letterboxed to it once
+RESULT_TIMEOUT = 5.0    # seconds a Game waits for its detections before serving the frame without them
+
+
+class DetectorBackend:
+    """
+    A loaded person detector. Calling it with a list of letterboxed BGR frames returns
+    one (N, 5) float32 array of x1, y1, x2, y2, conf per frame.
+    Calls are serialized with a per-model lock (the ultralytics predictor is not safe
+    to run from several threads at once) and timed, so backends can be compared.
+    """
+    name = None
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.lock = threading.Lock()
+        self.nbytes = 0
+        self.calls = 0
+        self.frames = 0
+        self.total_time = 0.0
+        self.last_latency = 0.0     # seconds per frame in the last call
+
+    @property
+    def key(self):
+        return (self.name, self.weights)
+
+    def __call__(self, frames):
+        with self.lock:
+            start = time.perf_counter()
+            boxes = self.infer(frames)
+            elapsed = time.perf_counter() - start
+            self.calls += 1
+            self.frames += len(frames)
+            self.total_time += elapsed
+            self.last_latency = elapsed / max(len(frames), 1)
+        return boxes
+
+    def infer(self, frames):
+        raise NotImplementedError
+
+    def latency(self):
+        # Mean and last per-frame latency in milliseconds
+        mean = self.total_time / self.frames if self.frames else 0.0
+        return {'backend': self.name, 'weights': self.weights, 'frames': self.frames,
+                'mean_ms': mean * 1000, 'last_ms': self.last_latency * 1000}
+
+
+class UltralyticsBackend(DetectorBackend):
+    name = "ultralytics"
+
+    def __init__(self, weights):
+        super().__init__(weights)
+        from ultralytics import YOLO   # pulls in torch, only loaded when this backend is used
+        self.model = YOLO(weights)
+        self.nbytes = model_size(self.model)
+
+    def infer(self, frames):
+        return [person_boxes(result) for result in self.model(frames, verbose=False)]
+
+
+class OnnxRuntimeBackend(DetectorBackend):
+    name = "onnxruntime"
+
+    def __init__(self, weights):
+        super().__init__(weights)
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(weights, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        # Models exported without a dynamic batch axis only take one frame per run
+        self.batched = not isinstance(self.session.get_inputs()[0].shape[0], int)
+        self.nbytes = os.path.getsize(weights)
+
+    def infer(self, frames):
+        if self.batched:
+            outputs = self.session.run(None, {self.input_name: to_blob(frames)})[0]
+        else:
+            outputs = np.concatenate([self.session.run(None, {self.input_name: to_blob([frame])})[0]
+                                      for frame in frames])
+        return [decode_output(output, frame.shape) for output, frame in zip(outputs, frames)]
+
+
+class OpenCVDnnBackend(DetectorBackend):
+    name = "opencv"
+
+    def __init__(self, weights):
+        super().__init__(weights)
+        self.net = cv2.dnn.readNetFromONNX(weights)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.nbytes = os.path.getsize(weights)
+
+    def infer(self, frames):
+        boxes = []
+        for frame in frames:
+            self.net.setInput(to_blob([frame]))
+            boxes.append(decode_output(self.net.forward()[0], frame.shape))
+        return boxes
+
+
+BACKENDS = {backend.name: backend for backend in (UltralyticsBackend, OnnxRuntimeBackend, OpenCVDnnBackend)}
+
+
+class DetectorRegistry:
+    """
+    Process-wide cache of loaded detector models.
+    Every Game borrows a model with acquire() and hands it back with release(),
+    so the weights are loaded once no matter how many players are connected.
+    """
+
+    def __init__(self, backends=BACKENDS):
+        self.backends = backends
+        self.lock = threading.Lock()
+        self.entries = {}   # (backend, weights) -> { 'detector':DetectorBackend, 'refs':int, 'load_time':float, 'ready':Event }
+
+    def acquire(self, weights=DEFAULT_WEIGHTS, backend=DEFAULT_BACKEND):
+        key = (backend, weights)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = {'detector': None, 'refs': 0, 'load_time': 0.0,
+                         'ready': threading.Event(), 'error': None}
+                self.entries[key] = entry
+                owner = True
+            else:
+                owner = False
+            entry['refs'] += 1
+
+        if owner:
+            # Load outside the registry lock so other models stay available meanwhile
+            start = time.time()
+            try:
+                detector = self.backends[backend](weights)
+                entry['detector'] = detector
+                entry['load_time'] = time.time() - start
+                print(f"[Detector] loaded {weights} with {backend} "
+                      f"({detector.nbytes / 2**20:.1f} MB in {entry['load_time']:.2f}s)")
+            except Exception as e:
+                entry['error'] = e
+                with self.lock:
+                    self.entries.pop(key, None)
+            finally:
+                entry['ready'].set()
+        else:
+            entry['ready'].wait()
+
+        if entry['error'] is not None:
+            raise entry['error']
+        return entry['detector']
+
+    def release(self, detector):
+        with self.lock:
+            entry = self.entries.get(detector.key)
+            if entry is None or entry['detector'] is not detector:
+                return
+            entry['refs'] -= 1
+            if entry['refs'] <= 0:
+                del self.entries[detector.key]
+                print(f"[Detector] unloaded {detector.weights} ({detector.name})")
+
+    def report(self):
+        # One row per loaded model: references held, memory used by its weights and latency
+        with self.lock:
+            return [dict(entry['detector'].latency(), refs=entry['refs'], bytes=entry['detector'].nbytes,
+                         load_time=entry['load_time'])
+                    for entry in self.entries.values() if entry['detector'] is not None]
+
+
+def model_size(model):
+    # Bytes held by the parameters and buffers of a torch-backed model
+    module = getattr(model, 'model', model)
+    try:
+        tensors = list(module.parameters()) + list(module.buffers())
+    except AttributeError:
+        return 0
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def person_boxes(result):
+    """
+    Returns an (N, 5) float32 array of x1, y1, x2, y2, conf for every confident
+    person in one ultralytics result.
+    """
+    data = result.boxes.data.cpu().numpy()
+    keep = (data[:, 5] == PERSON_CLASS) & (data[:, 4] > MIN_CONFIDENCE)
+    return np.ascontiguousarray(data[keep, :5], dtype=np.float32)
+
+
+def to_blob(frames):
+    # BGR uint8 frames -> RGB float32 NCHW in [0, 1]
+    return cv2.dnn.blobFromImages(frames, 1 / 255.0, (INPUT_SIZE, INPUT_SIZE), swapRB=True, crop=False)
+
+
+def decode_output(output, shape):
+    """
+    Turns one raw YOLOv8 output, (4 + classes, anchors), into person boxes.
+    Works for the stock 80-class head and for the person-only head from export().
+    """
+    preds = output.T
+    scores = preds[:, 4]
+    keep = scores > MIN_CONFIDENCE
+    if preds.shape[1] > 5:
+        keep &= preds[:, 4:].argmax(axis=1) == PERSON_CLASS
+    preds, scores = preds[keep], scores[keep]
+    if not len(preds):
+        return np.empty((0, 5), np.float32)
+
+    # cx, cy, w, h in network pixels -> x1, y1, w, h on the frame
+    sx, sy = shape[1] / INPUT_SIZE, shape[0] / INPUT_SIZE
+    tlwh = np.stack([(preds[:, 0] - preds[:, 2] / 2) * sx, (preds[:, 1] - preds[:, 3] / 2) * sy,
+                     preds[:, 2] * sx, preds[:, 3] * sy], axis=1)
+    picked = np.array(cv2.dnn.NMSBoxes(tlwh.tolist(), scores.tolist(), MIN_CONFIDENCE, NMS_IOU)).reshape(-1)
+    boxes = np.empty((len(picked), 5), np.float32)
+    boxes[:, :2] = tlwh[picked, :2]
+    boxes[:, 2:4] = tlwh[picked, :2] + tlwh[picked, 2:]
+    boxes[:, 4] = scores[picked]
+    return boxes
+
+
+class Letterbox:
+    """
+    Fits frames into one reused size x size buffer, keeping the aspect ratio and padding
+    the rest with grey. The detector sees a frame it does not have to resize again, and
+    to_display() maps boxes from buffer coordinates back onto the original frame.
+    """
+
+    def __init__(self, size=INPUT_SIZE):
+        self.size = size
+        self.buffer = np.full((size, size, 3), 114, np.uint8)
+        self.source = None
+        self.geometry = None    # (h, w) of the last source frame
+        self.scale = 1.0
+        self.pad = (0, 0)
+
+    def fit(self, frame):
+        if frame is self.source:
+            return self.buffer
+        h, w = frame.shape[:2]
+        if (h, w) != self.geometry:
+            self.geometry = (h, w)
+            self.scale = min(self.size / h, self.size / w)
+            new_w, new_h = int(round(w * self.scale)), int(round(h * self.scale))
+            self.pad = ((self.size - new_w) // 2, (self.size - new_h) // 2)
+            self.buffer[...] = 114
+        left, top = self.pad
+        new_h, new_w = int(round(h * self.scale)), int(round(w * self.scale))
+        target = self.buffer[top:top + new_h, left:left + new_w]
+        if (new_h, new_w) == (h, w):
+            target[...] = frame
+        else:
+            target[...] = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_AREA)
+        self.source = frame
+        return self.buffer
+
+    def to_display(self, x1, y1, w, h):
+        # Box in buffer coordinates -> box on the frame that was fitted
+        left, top = self.pad
+        return (int((x1 - left) / self.scale), int((y1 - top) / self.scale),
+                int(w / self.scale), int(h / self.scale))
+
+
+class InferenceRequest:
+    # A frame waiting for detections; result() blocks until the batch it rode in is done
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.boxes = None
+        self.error = None
+        self.done = threading.Event()
+
+    @classmethod
+    def completed(cls, boxes):
+        request = cls(None)
+        request.finish(boxes)
+        return request
+
+    def finish(self, boxes=None, error=None):
+        self.frame = None
+        self.boxes = boxes
+        self.error = error
+        self.done.set()
+
+    def result(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise TimeoutError("Detection request timed out")
+        if self.error is not None:
+            raise self.error
+        return self.boxes
+
+
+class InferenceScheduler:
+    """
+    Collects frames submitted by every Game in the process and runs them through the
+    detector as one batch. A batch closes when max_batch_size frames are waiting or
+    batch_window seconds have passed since its first frame arrived.
+    """
+
+    def __init__(self, weights=DEFAULT_WEIGHTS, backend=DEFAULT_BACKEND, batch_window=0.01, max_batch_size=8,
+                 report_interval=30):
+        self.detector = registry.acquire(weights, backend)
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.report_interval = report_interval
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.frames = 0
+        self.batch_sizes = [0] * (max_batch_size + 1)   # histogram of frames per batch
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, frame):
+        request = InferenceRequest(frame)
+        self.pending.put(request)
+        return request
+
+    def collect(self):
+        batch = [self.pending.get()]
+        deadline = time.time() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        last_report = time.time()
+        while True:
+            batch = self.collect()
+            try:
+                results = self.detector([request.frame for request in batch])
+                for request, boxes in zip(batch, results):
+                    request.finish(boxes)
+            except Exception as e:
+                print(f"[InferenceScheduler] batch of {len(batch)} failed:", e)
+                for request in batch:
+                    request.finish(error=e)
+
+            with self.lock:
+                self.batches += 1
+                self.frames += len(batch)
+                self.batch_sizes[len(batch)] += 1
+            if time.time() - last_report > self.report_interval:
+                last_report = time.time()
+                stats = self.stats()
+                print(f"[InferenceScheduler] {stats['batches']} batches, mean size {stats['mean_batch']:.2f}, "
+                      f"occupancy {stats['occupancy']:.0%}, {self.detector.latency()['mean_ms']:.1f} ms/frame")
+
+    def stats(self):
+        with self.lock:
+            mean_batch = self.frames / self.batches if self.batches else 0.0
+            return {'batches': self.batches, 'frames': self.frames, 'mean_batch': mean_batch,
+                    'occupancy': mean_batch / self.max_batch_size, 'batch_sizes': list(self.batch_sizes),
+                    'queued': self.pending.qsize()}
+
+
+registry = DetectorRegistry()
+
+
+class CalibrationFrames:
+    # Feeds letterboxed images from a folder to the INT8 calibrator
+
+    def __init__(self, folder, input_name, limit=200):
+        names = sorted(name for name in os.listdir(folder) if name.lower().endswith((".jpg", ".jpeg", ".png")))
+        self.paths = [os.path.join(folder, name) for name in names[:limit]]
+        self.input_name = input_name
+        self.letterbox = Letterbox()
+        self.index = 0
+
+    def get_next(self):
+        while self.index < len(self.paths):
+            image = cv2.imread(self.paths[self.index])
+            self.index += 1
+            if image is not None:
+                return {self.input_name: to_blob([self.letterbox.fit(image)])}
+        return None
+
+    def rewind(self):
+        self.index = 0
+
+
+def export(weights=DEFAULT_WEIGHTS, output=None, int8=False, calibration=None):
+    """
+    Exports ultralytics weights to an ONNX model whose head only keeps the person
+    channel, optionally quantized to INT8. Returns the path of the written model.
+    With a calibration folder the model is statically quantized (QDQ, usable by both
+    onnxruntime and OpenCV DNN); without one only the weights are quantized, which
+    onnxruntime supports but OpenCV DNN does not.
+    """
+    import onnx
+    from onnx import helper, TensorProto
+    from ultralytics import YOLO
+
+    onnx_path = YOLO(weights).export(format="onnx", imgsz=INPUT_SIZE, dynamic=True, simplify=True)
+    model = onnx.load(onnx_path)
+    graph = model.graph
+    raw = graph.output[0].name
+    # (batch, 4 + 80, anchors) -> (batch, 4 + 1, anchors)
+    graph.initializer.extend([helper.make_tensor("person_starts", TensorProto.INT64, [1], [0]),
+                              helper.make_tensor("person_ends", TensorProto.INT64, [1], [4 + PERSON_CLASS + 1]),
+                              helper.make_tensor("person_axes", TensorProto.INT64, [1], [1])])
+    graph.node.append(helper.make_node("Slice", [raw, "person_starts", "person_ends", "person_axes"], ["person"]))
+    del graph.output[:]
+    graph.output.append(helper.make_tensor_value_info("person", TensorProto.FLOAT, ["batch", 5, "anchors"]))
+
+    base = output or os.path.splitext(weights)[0] + "_person"
+    fp32_path = base + ".onnx"
+    onnx.save(model, fp32_path)
+    print(f"[Detector] wrote {fp32_path}")
+    if not int8:
+        return fp32_path
+
+    from onnxruntime import quantization
+    int8_path = base + "_int8.onnx"
+    if calibration:
+        reader = CalibrationFrames(calibration, graph.input[0].name)
+        quantization.quantize_static(fp32_path, int8_path, reader, quant_format=quantization.QuantFormat.QDQ,
+                                     per_channel=True, activation_type=quantization.QuantType.QUInt8,
+                                     weight_type=quantization.QuantType.QInt8)
+    else:
+        quantization.quantize_dynamic(fp32_path, int8_path, weight_type=quantization.QuantType.QInt8)
+    print(f"[Detector] wrote {int8_path}")
+    return int8_path
+
+
+def benchmark(models, frames=50, batch=1, images=None):
+    """
+    Times every (backend, weights) pair on the same letterboxed frames.
+    Returns one latency row per model, fastest first.
+    """
+    letterbox = Letterbox()
+    if images:
+        names = sorted(os.listdir(images))[:frames]
+        samples = [letterbox.fit(cv2.imread(os.path.join(images, name))).copy() for name in names]
+    else:
+        samples = [np.random.randint(0, 255, (INPUT_SIZE, INPUT_SIZE, 3), np.uint8) for _ in range(frames)]
+
+    rows = []
+    for backend, weights in models:
+        detector = BACKENDS[backend](weights)
+        detector(samples[:batch])   # warm up
+        detector.frames = detector.calls = 0
+        detector.total_time = 0.0
+        for i in range(0, len(samples), batch):
+            detector(samples[i:i + batch])
+        rows.append(dict(detector.latency(), bytes=detector.nbytes))
+    return sorted(rows, key=lambda row: row['mean_ms'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detector export and backend benchmark")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_cmd = commands.add_parser("export", help="export a person-only ONNX model")
+    export_cmd.add_argument("--weights", default=DEFAULT_WEIGHTS)
+    export_cmd.add_argument("--output", help="path without extension")
+    export_cmd.add_argument("--int8", action="store_true", help="also write an INT8 quantized model")
+    export_cmd.add_argument("--calibration", help="folder of sample frames for static INT8 calibration")
+
+    bench_cmd = commands.add_parser("bench", help="compare backend latency")
+    bench_cmd.add_argument("models", nargs="+", help="backend=weights, e.g. onnxruntime=yolov8n_person_int8.onnx")
+    bench_cmd.add_argument("--frames", type=int, default=50)
+    bench_cmd.add_argument("--batch", type=int, default=1)
+    bench_cmd.add_argument("--images", help="folder of frames to use instead of noise")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export(args.weights, args.output, args.int8, args.calibration)
+    else:
+        models = [tuple(model.split("=", 1)) for model in args.models]
+        for row in benchmark(models, args.frames, args.batch, args.images):
+            print(f"{row['backend']:<12} {row['weights']:<36} {row['mean_ms']:8.2f} ms/frame "
+                  f"{row['bytes'] / 2**20:8.1f} MB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
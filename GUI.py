@@ -1,7 +1,9 @@
 
 # gui_client_pyqt.py
 import Utils
-import sys, socket, struct, threading, json
+import Overlay
+import Datagrams
+import sys, socket, threading, json, time
 import cv2, numpy as np
 from PyQt5 import QtCore, QtWidgets, QtGui
 from PyQt5.QtWidgets import QVBoxLayout, QSpacerItem, QSizePolicy
@@ -16,11 +18,17 @@ with open("client_settings.json") as f:
     TARGET_FPS = CFG["TARGET_FPS"]
     WIDTH, HEIGHT = CFG["FRAME_WIDTH"], CFG["FRAME_HEIGHT"]
     JPEG_Q = CFG["JPEG_QUALITY"]
+    DOWNSTREAM = CFG.get("DOWNSTREAM", "frames")   # "annotations": the server sends boxes, drawn here
+    DATAGRAMS = CFG.get("DATAGRAMS", False)        # upload frames over UDP when the server offers it
+
+CREDIT_TIMEOUT = 0.5   # seconds out of credit on datagrams before the uploads in flight are taken as lost
 
 # ─── Network Thread ────────────────────────────────────────────────────────────
 
 class NetworkThread(QtCore.QThread):
     frame_received = QtCore.pyqtSignal(np.ndarray, bool)
+    annotations_received = QtCore.pyqtSignal(object, bool)
+    control_received = QtCore.pyqtSignal(object)        # credit, fps and quality from the server
     finished = QtCore.pyqtSignal()
 
     def __init__(self, sock, aes, role):
@@ -33,15 +41,23 @@ class NetworkThread(QtCore.QThread):
 
     def run(self):
         try:
+            # Frames are received and decrypted in one reused buffer
+            reader = Utils.FrameReader(self.sock, self.aes)
             while self.running:
                 # Header: 1 byte game_active (ignored here) + 1 byte alive + 4 bytes size
-                header = Utils.recv_encrypted(self.sock, self.aes)
-                game_active, alive, red_light = struct.unpack(">???", header[:3])
-                payload = header[3:]
-                arr = np.frombuffer(payload, np.uint8)
-                frame = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-                if frame is not None:
-                    self.frame_received.emit(frame, red_light)
+                header = reader.read()
+                game_active, alive, red_light, kind = Utils.DOWNSTREAM_HEADER.unpack_from(header)
+                payload = header[Utils.DOWNSTREAM_HEADER.size:]
+                if kind == Utils.DOWNSTREAM_ANNOTATIONS:
+                    self.annotations_received.emit(json.loads(bytes(payload)), red_light)
+                elif kind == Utils.DOWNSTREAM_CONTROL:
+                    self.control_received.emit(json.loads(bytes(payload)))
+                    continue
+                else:
+                    arr = np.frombuffer(payload, np.uint8)
+                    frame = cv2.imdecode(arr, cv2.IMREAD_COLOR)
+                    if frame is not None:
+                        self.frame_received.emit(frame, red_light)
                 if not game_active:
                     break
                 self.msleep(33)
@@ -58,24 +74,76 @@ class NetworkThread(QtCore.QThread):
 # ─── Player Capture Thread ─────────────────────────────────────────────────────
 
 class CaptureThread(QtCore.QThread):
-    send_frame = QtCore.pyqtSignal(bytes)
+    send_frame = QtCore.pyqtSignal(bytes, int, float)   # jpeg, sequence number, capture time
+    captured = QtCore.pyqtSignal(np.ndarray)            # the raw frame, for drawing annotations on
 
-    def __init__(self):
+    def __init__(self, credit_timeout=None):
         super().__init__()
         self.cap = cv2.VideoCapture(0)
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, WIDTH)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, HEIGHT)
         self.running = True
+        self.seq = 0
+        # Uploads the server is ready for; granted from the GUI thread, taken here.
+        # Datagrams can be lost with the credit they hold, so after credit_timeout one is sent anyway
+        # and the server credits the missing sequence numbers back when it arrives
+        self.credit_lock = threading.Lock()
+        self.credits = 0
+        self.credit_timeout = credit_timeout
+        self.starved_since = None
+        # What the server currently asks for, never above the settings file
+        self.fps = TARGET_FPS
+        self.quality = JPEG_Q
+
+    def on_control(self, control):
+        if control.get("credit"):
+            with self.credit_lock:
+                self.credits += int(control["credit"])
+        if "fps" in control:
+            self.fps = min(max(1, int(control["fps"])), TARGET_FPS)
+        if "quality" in control:
+            self.quality = min(max(1, int(control["quality"])), JPEG_Q)
+
+    def take_credit(self):
+        with self.credit_lock:
+            now = time.monotonic()
+            if self.starved_since is None:
+                self.starved_since = now
+            if self.credits > 0 or (self.credit_timeout is not None and now - self.starved_since > self.credit_timeout):
+                self.credits -= 1
+                self.starved_since = None
+                return True
+            return False
+
+    def return_credit(self):
+        with self.credit_lock:
+            self.credits += 1
 
     def run(self):
+        deadline = time.monotonic()
         while self.running:
+            capture_ts = time.time()
             ret, frame = self.cap.read()
             if not ret:
                 break
+            if frame.shape[1] != WIDTH or frame.shape[0] != HEIGHT:
+                # The camera ignored the requested size
+                frame = cv2.resize(frame, (WIDTH, HEIGHT), interpolation=cv2.INTER_AREA)
+            self.captured.emit(frame)
+            if not self.take_credit():
+                # The server has not caught up; keep reading so the next frame sent is a fresh one
+                continue
             # check for win flag
-            success, jpg = cv2.imencode('.jpg', frame)
+            success, jpg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
             if success:
                 data = jpg.tobytes()
-                self.send_frame.emit(data)
-            self.msleep(33)  # ~30 FPS
+                self.seq += 1
+                self.send_frame.emit(data, self.seq, capture_ts)
+            else:
+                self.return_credit()
+            # Pace to the asked rate from a fixed schedule, so capture and encode time do not add up
+            deadline = max(deadline + 1 / self.fps, time.monotonic())
+            self.msleep(int((deadline - time.monotonic()) * 1000))
 
     def stop(self):
         self.running = False
@@ -350,7 +418,11 @@ class MenuWindow(QtWidgets.QMainWindow):
             "user": self.user,
             "role": role,
             "light_duration": int(light_dur) if light_dur.isdigit() else light_dur,
-            "max_players": int(max_pl)
+            "max_players": int(max_pl),
+            "downstream": DOWNSTREAM,
+            "fps": TARGET_FPS,
+            "quality": JPEG_Q,
+            "datagrams": DATAGRAMS
         }).encode()
 
         Utils.send_encrypted(self.sock, self.aes, msg)
@@ -363,7 +435,7 @@ class MenuWindow(QtWidgets.QMainWindow):
             self.settings_widget.setVisible(False)
             self.join_widget.setVisible(False)
 
-            self.game_window = GameWindow(self.sock, self.aes, role, room_id)
+            self.game_window = GameWindow(self.sock, self.aes, role, room_id, reply)
             self.game_window.show()
             self.hide()  # hide this window itself
         else:
@@ -392,7 +464,11 @@ class MenuWindow(QtWidgets.QMainWindow):
             "action":  "join_game",
             "user":    self.user,
             "role":    role,
-            "room_id": room_id
+            "room_id": room_id,
+            "downstream": DOWNSTREAM,
+            "fps": TARGET_FPS,
+            "quality": JPEG_Q,
+            "datagrams": DATAGRAMS
         }).encode()
         Utils.send_encrypted(self.sock, self.aes, msg)
         reply_buffer = Utils.recv_encrypted(self.sock, self.aes)
@@ -403,7 +479,7 @@ class MenuWindow(QtWidgets.QMainWindow):
             self.settings_widget.setVisible(False)
             self.join_widget.setVisible(False)
 
-            self.game_window = GameWindow(self.sock, self.aes, role, room_id)
+            self.game_window = GameWindow(self.sock, self.aes, role, room_id, reply)
             self.game_window.show()
             self.hide()
         else:
@@ -436,16 +512,23 @@ class MenuWindow(QtWidgets.QMainWindow):
 # ─── Game Window ────────────────────────────────────────────────────────────────
 
 class GameWindow(QtWidgets.QMainWindow):
-    def __init__(self, sock, aes, role, room_id):
+    def __init__(self, sock, aes, role, room_id, reply=None):
         super().__init__()
         self.sock = sock
         self.aes = aes
+        # Frames go over UDP when the server opened a datagram channel for us, everything else stays on TCP
+        self.uplink = None
+        if reply and reply.get("channel"):
+            udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp.connect((SERVER_HOST, reply["datagram_port"]))
+            self.uplink = Datagrams.DatagramSender(udp, aes, bytes.fromhex(reply["channel"]))
         self.WIDTH = 1200
         self.HEIGHT = 900
         super().resize(self.WIDTH, self.HEIGHT)
         self.setWindowTitle(f"Red Light Green Light — {role.title()}")
         self.role = role
         self.win_flag = False
+        self.last_frame = None   # latest camera frame, annotations are drawn on it
 
         # Central widget: a QLabel to display video
         self.centralwidget = QtWidgets.QWidget(self)
@@ -530,25 +613,48 @@ class GameWindow(QtWidgets.QMainWindow):
             # 4) Wire it up
             self.win_button.setText("Win!")
             self.win_button.clicked.connect(self.button_pressed)
-            self.cap_thread = CaptureThread()
+            self.cap_thread = CaptureThread(CREDIT_TIMEOUT if self.uplink else None)
             self.cap_thread.send_frame.connect(self.on_send_frame)
+            self.cap_thread.captured.connect(self.on_captured)
+            # The client only encodes and sends while it holds credit, the first comes with the reply
+            self.cap_thread.on_control({"credit": (reply or {}).get("credit", 0)})
             self.cap_thread.start()
 
         # Threads
         self.net_thread = NetworkThread(self.sock, self.aes, role)
         self.net_thread.frame_received.connect(self.update_frame)
+        self.net_thread.annotations_received.connect(self.on_annotations)
+        if role == "player":
+            self.net_thread.control_received.connect(self.cap_thread.on_control)
         self.net_thread.finished.connect(self.on_finished)
         self.net_thread.start()
 
 
     def button_pressed(self):
         self.win_flag = True
-    def on_send_frame(self, buffer):
-        # header: 1 byte win + 4 byte size
-        plaintext = struct.pack(">?",  self.win_flag) + buffer
+    def on_send_frame(self, buffer, seq, capture_ts):
+        # header: 1 byte win + 4 byte sequence number + 8 byte capture time
+        plaintext = Utils.UPLOAD_HEADER.pack(self.win_flag, seq, capture_ts) + buffer
+        if self.uplink is not None:
+            try:
+                self.uplink.send(plaintext)
+                return
+            except OSError as e:
+                print("[Datagrams] upload failed, back to TCP:", e)
+                self.uplink = None
         Utils.send_encrypted(self.sock, self.aes, plaintext)
 
 
+    def on_captured(self, frame):
+        self.last_frame = frame
+
+    def on_annotations(self, annotations, red_light):
+        # Draw the server's boxes on our own latest frame instead of receiving it back as a JPEG
+        if self.last_frame is None and not annotations.get('result'):
+            return
+        frame = self.last_frame.copy() if self.last_frame is not None else None
+        self.update_frame(Overlay.draw_annotations(frame, annotations), red_light)
+
     def update_background(self, red_light : bool):
         palette = QtGui.QPalette()
         if red_light:
@@ -600,6 +706,7 @@ def main():
     aes_key = get_random_bytes(16)  # 128 bits
     enc_aes = Utils.rsa_encrypt(server_rsa_pub, aes_key)
     sock.send(len(enc_aes).to_bytes(4, "big") + enc_aes)
+    session = Utils.CryptoSession(aes_key, server=False)
 
     # 4) Now loop over login/signup: everything is under AES
     login_success = False
@@ -611,10 +718,10 @@ def main():
         action, user, pw = dialog.get_result()
         # Send auth JSON
         msg = json.dumps({"action": action, "user": user, "pass": pw}).encode()
-        Utils.send_encrypted(sock, aes_key, msg)
+        Utils.send_encrypted(sock, session, msg)
 
         # Validate auth
-        raw = Utils.recv_encrypted(sock, aes_key)
+        raw = Utils.recv_encrypted(sock, session)
         reply = json.loads(raw)
         if reply.get("ok"):
             login_success = True
@@ -626,7 +733,7 @@ def main():
         QtWidgets.QMessageBox.critical(None, "Auth Failed", "Too many attempts, login failed.")
         sys.exit(1)
 
-    win = MenuWindow(sock, aes_key, user)
+    win = MenuWindow(sock, session, user)
     win.show()
     sys.exit(app.exec_())
 
@@ -2,113 +2,310 @@ import cv2
 import numpy as np
 import imutils
 import time
-from ultralytics import YOLO
 from deep_sort_realtime.deepsort_tracker import DeepSort
+import Detector
+import Overlay
+from Tracking import FlowInterpolator, MotionGate, IouTracker
+
+MOVE_TOLERANCE = 5      # pixels a player's center may shift during red light
+MAX_STATIC_FRAMES = 15  # frames the motion gate may serve from old boxes before the detector runs anyway
+TRACKERS = ("deepsort", "iou")
+
+
+def make_tracker(name):
+    # DeepSort matches on appearance embeddings, "iou" on box overlap only (much cheaper on CPU)
+    if name == "iou":
+        return IouTracker(max_age=100)
+    return DeepSort(max_age=100)
+
+
+class PlayerTable:
+    """
+    Position and status of every registered player, one row per track id in a
+    structured array, so the per-frame checks run over all players at once.
+    """
+    DTYPE = np.dtype([('id', np.int64), ('cx', np.int32), ('cy', np.int32), ('area', np.int64), ('alive', np.bool_)])
+
+    def __init__(self, capacity=8):
+        self.rows = np.zeros(capacity, self.DTYPE)
+        self.size = 0
+
+    @property
+    def players(self):
+        return self.rows[:self.size]
+
+    def __len__(self):
+        return self.size
+
+    def lookup(self, ids):
+        # Row index of every id, -1 for ids that are not registered
+        players = self.players
+        index = np.full(len(ids), -1, np.intp)
+        if not len(players) or not len(ids):
+            return index
+        order = np.argsort(players['id'])
+        sorted_ids = players['id'][order]
+        pos = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+        found = sorted_ids[pos] == ids
+        index[found] = order[pos[found]]
+        return index
+
+    def add(self, ids, cx, cy, area):
+        count = len(ids)
+        if self.size + count > len(self.rows):
+            grown = np.zeros(max(2 * len(self.rows), self.size + count), self.DTYPE)
+            grown[:self.size] = self.players
+            self.rows = grown
+        new = self.rows[self.size:self.size + count]
+        new['id'], new['cx'], new['cy'], new['area'], new['alive'] = ids, cx, cy, area, True
+        self.size += count
+
+    def update(self, ids, cx, cy, area, red_light, register=False):
+        """
+        Moves known players to their new centers, eliminating anyone who moved more than
+        MOVE_TOLERANCE during red light, and registers unknown ids when `register` is set.
+        Returns the row index per id (-1 if it is not a player) after the update.
+        """
+        index = self.lookup(ids)
+        known = index >= 0
+        rows = index[known]
+        players = self.players
+        if red_light and len(rows):
+            moved = ((np.abs(cx[known] - players['cx'][rows]) > MOVE_TOLERANCE)
+                     | (np.abs(cy[known] - players['cy'][rows]) > MOVE_TOLERANCE))
+            players['alive'][rows[moved]] = False
+        players['cx'][rows], players['cy'][rows], players['area'][rows] = cx[known], cy[known], area[known]
+        if register and not known.all():
+            self.add(ids[~known], cx[~known], cy[~known], area[~known])
+            index[~known] = -1  # first sighting: registered, but not drawn until the next frame
+        return index
+
+    def any_alive(self):
+        return bool(self.players['alive'].any())
+
+    def winner(self):
+        # Id of the living player with the largest box, None if nobody qualifies
+        players = self.players
+        candidates = np.flatnonzero(players['alive'] & (players['area'] > 0))
+        if not len(candidates):
+            return None
+        return int(players['id'][candidates[np.argmax(players['area'][candidates])]])
 
 
 class Game:
 
-    def __init__(self):
-        # ML
-        self.model = YOLO("yolov8n.pt")
-        self.tracker = DeepSort(max_age=100)
+    def __init__(self, scheduler=None, weights=Detector.DEFAULT_WEIGHTS, detect_interval=1, motion_threshold=0.002,
+                 backend=Detector.DEFAULT_BACKEND, tracker="deepsort"):
+        # ML (the detector is shared by every Game in the process)
+        self.scheduler = scheduler
+        self.model = Detector.registry.acquire(weights, backend) if scheduler is None else None
+        self.tracker = make_tracker(tracker)
+        # Detection and tracking work on the frame letterboxed to the network input size
+        self.letterbox = Detector.Letterbox()
+        # Between detector runs the boxes are moved with optical flow
+        self.detect_interval = detect_interval
+        self.interpolator = FlowInterpolator()
+        self.frames_since_detect = 0
+        self.force_detect = True
+        self.detect_count = 0
+        # Frames that barely differ from the last processed one reuse its boxes
+        self.gate = MotionGate(motion_threshold) if motion_threshold > 0 else None
+        self.skip_count = 0
+        self.plan_frame = None
+        self.current_plan = None
+        self.gated = False   # the motion gate kept the current frame from the detector
+        self.boxes = []
+        self.timing = {}   # seconds spent in detector, tracker and overlay on the last frame
         # Game variables
         self.red_light = False
         self.active = True
         self.winner = None
+        self.result = None   # end-of-game message
+        self.overlay = []    # (id, x, y, w, h, alive) of the last frame, as fractions of the frame size
         self.frame_count = 0
         self.start_time = time.time()
-        self.players_position = {}
-        self.players_status = {}
+        self.players = PlayerTable()
 
     def change_light(self):
         self.red_light = not self.red_light  # Toggle game state
+        self.force_detect = True  # fresh positions to compare against when the light changes
+
+    def close(self):
+        # Hand the shared detector back to the registry
+        if self.model is not None:
+            Detector.registry.release(self.model)
+            self.model = None
 
 
     def check_lost(self):
         # Conditions for game lose
         canvas = None
-        if (self.frame_count > 5 and (not any(self.players_status.values()))):
+        if (self.frame_count > 5 and not self.players.any_alive()):
             self.active = False
             message = "Game lost!"
-            canvas = 255 * np.ones((200, 600, 3), dtype=np.uint8)
-            cv2.putText(canvas, message, (20, 100), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 255), 3)
+            self.result = message
+            canvas = Overlay.cache.end_screen(message, (200, 600), (0, 0, 255))
         return canvas
 
     def get_winner(self):
         # Find the player with the largest area
-        max_area = 0
-        winner_id = None
-        for track_id, (_, _, area) in self.players_position.items():
-            if self.players_status.get(track_id, True) and area > max_area:
-                max_area = area
-                winner_id = track_id
+        winner_id = self.players.winner()
         self.active = False
         self.winner = winner_id
         message = f"Winner is: {winner_id}!"
-        canvas = 255 * np.ones((200, 600, 3), dtype=np.uint8)
-        cv2.putText(canvas, message, (20, 100), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 255), 3)
+        self.result = message
+        canvas = Overlay.cache.end_screen(message, (200, 600), (0, 0, 255))
         return canvas
 
-    def get_detections(self, frame):
-        # Detect all human objects
-        detections = []
-        results = self.model(frame)
-        for result in results:
-            for box in result.boxes:
-                cls = int(box.cls[0])
-                conf = box.conf[0]
-                if cls == 0 and conf > 0.5:
-                    x1, y1, x2, y2 = map(int, box.xyxy[0])
-                    detections.append([[x1, y1, x2 - x1, y2 - y1], conf, None])
-        return detections
+    def needs_detection(self):
+        # The detector must run while players are being registered, after a light change
+        # or a miss, and whenever the flow tracking lost a player
+        return self.force_detect or self.frame_count < 5 or self.interpolator.lost
 
-    def update_values(self, frame, win):
-        # Update frame count
-        self.frame_count = self.frame_count + 1
+    def detection_due(self):
+        # Every detect_interval frames, moving or not
+        return self.frames_since_detect + 1 >= self.detect_interval
 
+    def plan(self, frame):
+        # Decide once per frame how it is served: 'detect' when it must or the interval is
+        # due, else 'interpolate' from the last boxes. The motion gate only adds skips: a
+        # due detection on a static frame is put off, for at most MAX_STATIC_FRAMES frames
+        if self.plan_frame is not frame:
+            self.plan_frame = frame
+            # Always checked, so the gate has this frame's thumbnail if it ends up detected
+            static = self.gate is not None and self.gate.is_static(self.letterbox.fit(frame))
+            self.gated = False
+            if self.needs_detection():
+                self.current_plan = 'detect'
+            elif not self.detection_due():
+                self.current_plan = 'interpolate'
+            elif static and self.frames_since_detect + 1 < MAX_STATIC_FRAMES:
+                self.current_plan = 'interpolate'
+                self.gated = True
+            else:
+                self.current_plan = 'detect'
+        return self.current_plan
 
-        # Detect all human objects
-        detections = self.get_detections(frame)
-        tracks = self.tracker.update_tracks(detections, frame=frame)
+    def stats(self):
+        frames = max(self.frame_count, 1)
+        return {'frames': self.frame_count, 'detections': self.detect_count,
+                'skipped': self.skip_count, 'skip_rate': self.skip_count / frames}
+
+    def request_detections(self, frame):
+        # Queue the frame on the shared scheduler, or run the detector right away.
+        # Returns None when this frame will be served without the detector
+        if self.plan(frame) != 'detect':
+            return None
+        return self.submit_frame(self.letterbox.fit(frame))
 
-        # Handle each player
+    def submit_frame(self, frame):
+        if self.scheduler is not None:
+            return self.scheduler.submit(frame)
+        boxes = self.model([frame])[0]
+        return Detector.InferenceRequest.completed(boxes)
+
+    def get_detections(self, frame, request=None):
+        # Detect all human objects; None when the detector failed or did not answer in time
+        if request is None:
+            request = self.submit_frame(frame)
+        try:
+            boxes = request.result(Detector.RESULT_TIMEOUT)
+        except Exception as e:
+            print("[Game] detection failed:", e)
+            return None
+        detections = []
+        for x1, y1, x2, y2, conf in boxes:
+            x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+            detections.append([[x1, y1, x2 - x1, y2 - y1], float(conf), None])
+        return detections
+
+    def track_players(self, frame, request=None):
+        # Full detect + DeepSort update; returns (track_id, x1, y1, w, h) per confirmed track
+        start = time.perf_counter()
+        detections = self.get_detections(frame, request)
+        detected = time.perf_counter()
+        if detections is None:
+            # Keep the last boxes for this frame and try the detector again on the next one
+            self.timing['detect'] = detected - start
+            self.force_detect = True
+            return self.boxes
+        tracks = self.tracker.update_tracks(detections, frame=frame)
+        self.timing['detect'] = detected - start
+        self.timing['track'] = time.perf_counter() - detected
+        boxes = []
+        self.force_detect = False
         for track in tracks:
             if not track.is_confirmed():
                 continue
-            track_id = track.track_id
+            if track.time_since_update > 0:
+                self.force_detect = True  # a known player was missed, detect again next frame
             x1, y1, w, h = map(int, track.to_tlwh())  # Extract bbox
-            area = w*h
-            x2, y2 = x1 + w, y1 + h
-            cx, cy = (x1 + x2) // 2, (y1 + y2) // 2  # Center point
-
-            # Detect movement when Red Light is on
-            if track_id in self.players_position:
-                prev_cx, prev_cy, _ = self.players_position[track_id]
-                if not self.players_status[track_id] or (self.red_light and (abs(cx - prev_cx) > 5 or abs(cy - prev_cy) > 5)):
-                    label = f"Player {track_id} - ELIMINATED!"
-                    self.players_status[track_id] = False
-                    color = (0, 0, 255)
-                else:
-                    label = f"Player {track_id}"
-                    color = (0, 255, 0)
-
-                # Update stored position
-                self.players_position[track_id] = (cx, cy, area)
-
-                # Draw bounding box and label
-                cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
-                cv2.putText(frame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
-
-            # Store first-time detected players
-            elif self.frame_count < 5:
-                self.players_position[track_id] = (cx, cy, area)
-                self.players_status[track_id] = True
+            boxes.append((track.track_id, x1, y1, w, h))
+        if self.gate is not None:
+            self.gate.accept()
+        self.interpolator.reset(frame, boxes)
+        self.frames_since_detect = 0
+        self.detect_count += 1
+        return boxes
+
+    def annotations(self):
+        # What update_values would draw, for a client that draws it on its own copy of the frame
+        return {'players': self.overlay, 'red_light': self.red_light, 'result': self.result}
+
+    def update_values(self, frame, win, request=None, draw=True, source_scale=1.0):
+        # source_scale: uploaded pixels per pixel of frame, when the upload was decoded reduced
+        plan = 'detect' if request is not None else self.plan(frame)
+        self.timing = {'plan': plan, 'detect': 0.0, 'track': 0.0, 'annotate': 0.0}
+        # Update frame count
+        self.frame_count = self.frame_count + 1
+
+
+        # Detect all human objects, or serve the frame from the last known boxes.
+        # Boxes stay in letterbox coordinates, only the overlay is mapped to the frame
+        image = self.letterbox.fit(frame)
+        if plan == 'detect':
+            boxes = self.track_players(image, request)
+        else:
+            start = time.perf_counter()
+            boxes = self.interpolator.update(image)
+            self.timing['track'] = time.perf_counter() - start
+            self.frames_since_detect += 1
+            self.skip_count += self.gated
+        self.boxes = boxes
+        annotate_start = time.perf_counter()
+        overlay = []
+
+        # Handle all players at once: movement check, elimination and registration
+        if boxes:
+            tlwh = np.array([box[1:] for box in boxes], np.int64)
+            ids = np.array([int(box[0]) for box in boxes], np.int64)
+            # Center point and area back in the pixels the client uploaded, so MOVE_TOLERANCE
+            # means the same whatever resolution the client's camera sends
+            left, top = self.letterbox.pad
+            scale = self.letterbox.scale / source_scale
+            cx = np.rint((tlwh[:, 0] + tlwh[:, 2] / 2 - left) / scale).astype(np.int64)
+            cy = np.rint((tlwh[:, 1] + tlwh[:, 3] / 2 - top) / scale).astype(np.int64)
+            area = np.rint(tlwh[:, 2] * tlwh[:, 3] / scale ** 2).astype(np.int64)
+            rows = self.players.update(ids, cx, cy, area, self.red_light, register=self.frame_count < 5)
+            alive = self.players.players['alive']
+
+            # Draw bounding box and label for every known player
+            fh, fw = frame.shape[:2]
+            for (track_id, x1, y1, w, h), row in zip(boxes, rows):
+                if row < 0:
+                    continue
+                dx1, dy1, dw, dh = self.letterbox.to_display(x1, y1, w, h)
+                overlay.append((int(track_id), round(dx1 / fw, 4), round(dy1 / fh, 4), round(dw / fw, 4),
+                                round(dh / fh, 4), bool(alive[row])))
+                if draw:
+                    Overlay.draw_player(frame, track_id, dx1, dy1, dw, dh, alive[row])
+
+        self.overlay = overlay
 
         # Display game state (Red/Green Light)
-        light_text = "RED LIGHT - STOP!" if self.red_light else "GREEN LIGHT - GO!"
-        light_color = (0, 0, 255) if self.red_light else (0, 255, 0)
-        cv2.putText(frame, light_text, (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1.2, light_color, 3)
+        if draw:
+            Overlay.draw_light(frame, self.red_light)
+        self.timing['annotate'] = time.perf_counter() - annotate_start
 
         # Game end conditions
         canvas = self.check_lost()
@@ -0,0 +1,237 @@
+import time
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+import Detector
+
+MAX_DETECTIONS = 64                 # person boxes a worker can report for one frame
+HEADER = np.dtype([('h', '<i4'), ('w', '<i4')])
+RESULT = np.dtype([('count', '<i4'), ('boxes', '<f4', (MAX_DETECTIONS, 5))])
+SUBMIT_TIMEOUT = 1.0    # seconds submit() waits for a free slot before failing the request
+WORKER_TIMEOUT = 10.0   # seconds a frame may sit in a worker before the worker is taken as hung
+WATCH_INTERVAL = 1.0    # seconds between worker liveness checks
+
+
+class FrameRing:
+    """
+    A fixed number of frame slots in one shared memory block, plus a result slot for each.
+    The server process writes decoded frames straight into a slot and the worker reads
+    them in place, so pixels are never pickled or copied through a pipe.
+    """
+
+    def __init__(self, slots, max_shape, name=None):
+        self.slots = slots
+        self.max_shape = max_shape
+        self.frame_bytes = HEADER.itemsize + int(np.prod(max_shape))
+        size = slots * (self.frame_bytes + RESULT.itemsize)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        frames_end = slots * self.frame_bytes
+        self.frames = np.ndarray((slots, self.frame_bytes), np.uint8, self.shm.buf[:frames_end])
+        self.results = np.ndarray((slots,), RESULT, self.shm.buf[frames_end:frames_end + slots * RESULT.itemsize])
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write_frame(self, slot, frame):
+        h, w = frame.shape[:2]
+        header = self.frames[slot, :HEADER.itemsize].view(HEADER)
+        header['h'], header['w'] = h, w
+        self.frame_view(slot, h, w)[...] = frame
+
+    def read_frame(self, slot):
+        header = self.frames[slot, :HEADER.itemsize].view(HEADER)[0]
+        return self.frame_view(slot, int(header['h']), int(header['w']))
+
+    def frame_view(self, slot, h, w):
+        pixels = self.frames[slot, HEADER.itemsize:HEADER.itemsize + h * w * 3]
+        return pixels.reshape(h, w, 3)
+
+    def write_boxes(self, slot, boxes):
+        count = min(len(boxes), MAX_DETECTIONS)
+        self.results[slot]['count'] = count
+        self.results[slot]['boxes'][:count] = boxes[:count]
+
+    def read_boxes(self, slot):
+        count = int(self.results[slot]['count'])
+        return self.results[slot]['boxes'][:count].copy()
+
+    def close(self, unlink=False):
+        # Drop our views first, SharedMemory refuses to close while they are alive
+        self.frames = None
+        self.results = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def worker_main(weights, backend, ring_name, slots, max_shape, tasks, done, threads):
+    # Runs in its own process: one detector, one ring, as many frames per call as are waiting
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    ring = FrameRing(slots, max_shape, name=ring_name)
+    detector = Detector.registry.acquire(weights, backend)
+    running = True
+    while running:
+        batch = [tasks.get()]
+        while not tasks.empty() and len(batch) < slots:
+            batch.append(tasks.get())
+        if None in batch:
+            running = False
+            batch = [slot for slot in batch if slot is not None]
+            if not batch:
+                break
+        try:
+            results = detector([ring.read_frame(slot) for slot in batch])
+            for slot, boxes in zip(batch, results):
+                ring.write_boxes(slot, boxes)
+                done.put((slot, None))
+        except Exception as e:
+            for slot in batch:
+                done.put((slot, repr(e)))
+    Detector.registry.release(detector)
+    ring.close()
+
+
+class InferenceService:
+    """
+    Detection in N worker processes, each with its own copy of the model and its own
+    shared memory ring. submit() has the same contract as Detector.InferenceScheduler,
+    so a Game can use either one. A worker that exits or sits on a frame for longer
+    than WORKER_TIMEOUT is replaced, and the requests it held fail instead of hanging.
+    """
+
+    def __init__(self, workers=2, weights=Detector.DEFAULT_WEIGHTS, backend=Detector.DEFAULT_BACKEND, slots=4,
+                 max_shape=(Detector.INPUT_SIZE, Detector.INPUT_SIZE, 3), threads_per_worker=1):
+        self.ctx = mp.get_context("spawn")   # torch does not survive fork once its thread pool has started
+        self.weights = weights
+        self.backend = backend
+        self.slots = slots
+        self.max_shape = max_shape
+        self.threads_per_worker = threads_per_worker
+        self.lock = threading.Condition()
+        self.closed = False
+        self.restarts = 0
+        self.workers = [self.start_worker(FrameRing(slots, max_shape)) for _ in range(workers)]
+        threading.Thread(target=self.watch_loop, daemon=True).start()
+        print(f"[InferenceService] {workers} workers started with {slots} slots each")
+
+    def start_worker(self, ring):
+        tasks, done = self.ctx.Queue(), self.ctx.Queue()
+        process = self.ctx.Process(target=worker_main, daemon=True,
+                                   args=(self.weights, self.backend, ring.name, self.slots, self.max_shape,
+                                         tasks, done, self.threads_per_worker))
+        process.start()
+        worker = {'ring': ring, 'tasks': tasks, 'done': done, 'process': process,
+                  'free': list(range(self.slots)), 'inflight': {}, 'processed': 0}
+        threading.Thread(target=self.collect_loop, args=(worker, ), daemon=True).start()
+        return worker
+
+    def submit(self, frame):
+        scale = 1.0
+        h, w = frame.shape[:2]
+        max_h, max_w = self.max_shape[:2]
+        if h > max_h or w > max_w:
+            scale = min(max_h / h, max_w / w)
+            frame = cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+        request = Detector.InferenceRequest(None)
+        request.scale = scale
+        with self.lock:
+            # Least loaded worker that still has a free slot; wait a little if every ring is full
+            deadline = time.monotonic() + SUBMIT_TIMEOUT
+            while True:
+                candidates = [worker for worker in self.workers if worker['free']]
+                if candidates:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # The caller holds its room lock, better a frame without detections than a stall
+                    request.finish(error=TimeoutError("No free inference slot"))
+                    return request
+                self.lock.wait(remaining)
+            worker = min(candidates, key=lambda worker: len(worker['inflight']))
+            slot = worker['free'].pop()
+            worker['inflight'][slot] = (request, time.monotonic())
+            # Still under the lock: restart() can neither hand this slot to a new worker's
+            # submit while the frame is copied in, nor leave the task on a dead worker's queue
+            worker['ring'].write_frame(slot, frame)
+            worker['tasks'].put(slot)
+        return request
+
+    def collect_loop(self, worker):
+        ring = worker['ring']
+        while True:
+            item = worker['done'].get()
+            if item is None:
+                return   # the worker was replaced
+            slot, error = item
+            boxes = ring.read_boxes(slot) if error is None else None
+            with self.lock:
+                entry = worker['inflight'].pop(slot, None)
+                if entry is None:
+                    continue   # already failed by restart()
+                request, _ = entry
+                worker['free'].append(slot)
+                worker['processed'] += 1
+                self.lock.notify()
+            if error is not None:
+                request.finish(error=RuntimeError(error))
+            else:
+                if request.scale != 1.0:
+                    boxes[:, :4] /= request.scale
+                request.finish(boxes)
+
+    def watch_loop(self):
+        while not self.closed:
+            time.sleep(WATCH_INTERVAL)
+            now = time.monotonic()
+            for i, worker in enumerate(list(self.workers)):
+                if self.closed:
+                    return
+                with self.lock:
+                    hung = any(now - submitted > WORKER_TIMEOUT for _, submitted in worker['inflight'].values())
+                if hung:
+                    self.restart(i, "hung")
+                elif not worker['process'].is_alive():
+                    self.restart(i, f"exited with code {worker['process'].exitcode}")
+
+    def restart(self, i, reason):
+        # Replaces worker i on the same ring; whatever it held fails so no Game waits on it
+        old = self.workers[i]
+        if old['process'].is_alive():
+            old['process'].kill()
+        old['process'].join(timeout=1)
+        with self.lock:
+            failed = [request for request, _ in old['inflight'].values()]
+            old['inflight'].clear()
+            old['done'].put(None)
+            self.workers[i] = self.start_worker(old['ring'])
+            self.restarts += 1
+            self.lock.notify_all()
+        print(f"[InferenceService] worker {old['process'].pid} {reason}, restarted; "
+              f"{len(failed)} requests failed")
+        for request in failed:
+            request.finish(error=RuntimeError(f"Inference worker {reason}"))
+
+    def stats(self):
+        with self.lock:
+            return [{'pid': worker['process'].pid, 'inflight': len(worker['inflight']),
+                     'processed': worker['processed'], 'alive': worker['process'].is_alive()}
+                    for worker in self.workers]
+
+    def close(self):
+        self.closed = True
+        for worker in self.workers:
+            worker['tasks'].put(None)
+        for worker in self.workers:
+            worker['process'].join(timeout=5)
+            worker['ring'].close(unlink=True)
@@ -0,0 +1,232 @@
+import bisect
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Upper bounds in seconds, from a cached overlay blit up to a stalled socket
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class HistogramChild:
+    # One label combination: cumulative bucket counts are only built when scraped
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum
+
+
+class CounterChild:
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Metric:
+    """
+    A named family of children, one per label combination. Recording is a dict lookup,
+    a lock and an addition; all formatting waits for a scrape.
+    """
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.make_child())
+        return child
+
+    def make_child(self):
+        raise NotImplementedError
+
+    def remove(self, *values):
+        # Drops every child whose label values start with these, e.g. one room's
+        with self.lock:
+            for key in [key for key in self.children if key[:len(values)] == values]:
+                del self.children[key]
+
+    def items(self):
+        with self.lock:
+            return list(self.children.items())
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def make_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value, *labels):
+        self.labels(*labels).observe(value)
+
+    def render(self):
+        lines = []
+        for values, child in self.items():
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"), ), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames + ('le', ), values + (le, ))} "
+                             f"{cumulative}")
+            labels = format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def make_child(self):
+        return CounterChild()
+
+    def inc(self, *labels, amount=1):
+        self.labels(*labels).inc(amount)
+
+    def render(self):
+        return [f"{self.name}{format_labels(self.labelnames, values)} {child.value}" for values, child in self.items()]
+
+
+class Gauge(Metric):
+    """
+    Read at scrape time from a callback returning [(label values, value), ...], so
+    state that already lives elsewhere (queue depths, scheduler stats) costs nothing
+    between scrapes.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), callback=None):
+        super().__init__(name, help, labelnames)
+        self.callback = callback
+
+    def render(self):
+        try:
+            samples = self.callback()
+        except Exception as e:
+            print(f"[Metrics] gauge {self.name} failed:", e)
+            return []
+        return [f"{self.name}{format_labels(self.labelnames, values)} {float(value)}" for values, value in samples]
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            # Re-registering returns the existing family so modules can declare at import time
+            return self.metrics.setdefault(metric.name, metric)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames, callback):
+        with self.lock:
+            self.metrics[name] = Gauge(name, help, labelnames, callback)
+            return self.metrics[name]
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Per-stage latency of the server's frame path, labelled by room and player
+stage_seconds = registry.histogram("rlgl_stage_seconds", "Time spent in one stage of the frame path",
+                                   ("room", "player", "stage"))
+uploads = registry.counter("rlgl_uploads_total", "Frames received from players", ("room", "player"))
+duplicates = registry.counter("rlgl_duplicate_uploads_total", "Uploads ignored as repeated or out of order",
+                              ("room", "player"))
+dropped = registry.counter("rlgl_dropped_uploads_total", "Uploads replaced before the game loop processed them",
+                           ("room", "player"))
+ROOM_METRICS = (stage_seconds, uploads, duplicates, dropped)
+
+
+def forget(room, player=None):
+    # Rooms are short lived: drop their children once a room ends or a player leaves it
+    values = (room, ) if player is None else (room, player)
+    for metric in ROOM_METRICS:
+        metric.remove(*values)
+
+# Connection setup: queueing for a handshake worker, RSA key exchange and login (which includes the user typing)
+HANDSHAKE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+handshake_seconds = registry.histogram("rlgl_handshake_seconds", "Time spent in one phase of connection setup",
+                                       ("phase", ), HANDSHAKE_BUCKETS)
+handshakes = registry.counter("rlgl_handshakes_total", "Connection setups by outcome", ("outcome", ))
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass   # one line per scrape would drown the game logs
+
+
+def serve(port, host="127.0.0.1", registry=registry):
+    # Prometheus text exposition on http://host:port/metrics from a daemon thread
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    httpd.registry = registry
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"[Metrics] serving on http://{host}:{httpd.server_address[1]}/metrics")
+    return httpd
@@ -0,0 +1,136 @@
+import threading
+import collections
+import cv2
+import numpy as np
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+class TextSprite:
+    """
+    A piece of text rendered once: a solid colour patch plus its alpha mask, ready to be
+    blended onto any frame. (dx, dy) is the offset from the putText origin to the top-left
+    corner. Hard-edged sprites (the cv2.putText default look) blit as a masked copy;
+    anti-aliased ones are alpha blended.
+    """
+
+    def __init__(self, text, scale, color, thickness, antialias=False):
+        (w, h), baseline = cv2.getTextSize(text, FONT, scale, thickness)
+        pad = thickness
+        self.alpha = np.zeros((h + baseline + 2 * pad, w + 2 * pad), np.uint8)
+        cv2.putText(self.alpha, text, (pad, h + pad), FONT, scale, 255, thickness,
+                    cv2.LINE_AA if antialias else cv2.LINE_8)
+        self.color = np.empty(self.alpha.shape + (3,), np.uint8)
+        self.color[...] = color
+        self.antialias = antialias
+        if antialias:
+            self.alpha3 = cv2.merge([self.alpha] * 3)
+            self.inverse3 = cv2.bitwise_not(self.alpha3)
+            self.premultiplied = cv2.multiply(self.color, self.alpha3, scale=1 / 255)
+        self.dx, self.dy = -pad, -(h + pad)
+        self.height, self.width = self.alpha.shape
+
+    def blit(self, frame, org):
+        # Same anchor cv2.putText would use, clipped to the frame
+        x, y = org[0] + self.dx, org[1] + self.dy
+        fx1, fy1 = max(x, 0), max(y, 0)
+        fx2, fy2 = min(x + self.width, frame.shape[1]), min(y + self.height, frame.shape[0])
+        if fx1 >= fx2 or fy1 >= fy2:
+            return
+        sx, sy = fx1 - x, fy1 - y
+        sprite = (slice(sy, sy + fy2 - fy1), slice(sx, sx + fx2 - fx1))
+        roi = frame[fy1:fy2, fx1:fx2]
+        if self.antialias:
+            cv2.add(cv2.multiply(roi, self.inverse3[sprite], scale=1 / 255), self.premultiplied[sprite], dst=roi)
+        else:
+            cv2.copyTo(self.color[sprite], self.alpha[sprite], roi)
+
+
+class OverlayCache:
+    """
+    Least-recently-used cache of rendered text sprites and end-screen images, keyed by
+    content and size. Per-frame annotation then costs a few small blends instead of
+    font rasterization, and end screens are drawn once per distinct message.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = render()
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+    def text(self, text, scale, color, thickness, antialias=False):
+        key = ('text', text, scale, tuple(color), thickness, antialias)
+        return self.get(key, lambda: TextSprite(text, scale, color, thickness, antialias))
+
+    def put_text(self, frame, text, org, scale, color, thickness, antialias=False):
+        # Drop-in for cv2.putText(frame, text, org, FONT, scale, color, thickness), LINE_AA if antialias
+        self.text(text, scale, color, thickness, antialias).blit(frame, org)
+
+    def end_screen(self, message, size, color, scale=1.2, thickness=3, org=(20, 100)):
+        # White canvas with one line of text; shared between callers, so it is read-only
+        key = ('screen', message, tuple(size), tuple(color), scale, thickness, org)
+
+        def render():
+            canvas = np.full((size[0], size[1], 3), 255, np.uint8)
+            cv2.putText(canvas, message, org, FONT, scale, color, thickness)
+            canvas.flags.writeable = False
+            return canvas
+
+        return self.get(key, render)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+cache = OverlayCache()
+
+
+def draw_player(frame, track_id, x, y, w, h, alive):
+    # Box and label for one player, in frame pixels
+    if alive:
+        label = f"Player {track_id}"
+        color = (0, 255, 0)
+    else:
+        label = f"Player {track_id} - ELIMINATED!"
+        color = (0, 0, 255)
+    cv2.rectangle(frame, (x, y), (x + w, y + h), color, 2)
+    cache.put_text(frame, label, (x, y - 10), 0.5, color, 2)
+
+
+def draw_light(frame, red_light):
+    # Display game state (Red/Green Light)
+    light_text = "RED LIGHT - STOP!" if red_light else "GREEN LIGHT - GO!"
+    light_color = (0, 0, 255) if red_light else (0, 255, 0)
+    cache.put_text(frame, light_text, (50, 50), 1.2, light_color, 3)
+
+
+def draw_annotations(frame, annotations):
+    """
+    Draws a Game.annotations() message on a frame of any size, the way the server would
+    have drawn it on its own copy. Returns the frame, or the end screen once there is a result.
+    """
+    if annotations.get('result'):
+        return cache.end_screen(annotations['result'], (200, 600), (0, 0, 255))
+    fh, fw = frame.shape[:2]
+    for track_id, x, y, w, h, alive in annotations['players']:
+        draw_player(frame, track_id, int(x * fw), int(y * fh), int(w * fw), int(h * fh), alive)
+    draw_light(frame, annotations['red_light'])
+    return frame
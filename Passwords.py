@@ -0,0 +1,96 @@
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import bcrypt
+
+DEFAULT_ROUNDS = 12
+
+
+class PasswordsBusy(Exception):
+    """More password checks are queued than the hasher accepts."""
+
+
+def hash_rounds(pw_hash):
+    # "$2b$12$..." -> 12
+    try:
+        return int(pw_hash.split(b"$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def hash_password(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def check_password(password, pw_hash, rounds):
+    """
+    Returns (ok, new_hash). new_hash is set when the password matched but the stored
+    hash used a different cost, so the caller can store the rehashed value.
+    """
+    if not bcrypt.checkpw(password, pw_hash):
+        return False, None
+    if hash_rounds(pw_hash) != rounds:
+        return True, hash_password(password, rounds)
+    return True, None
+
+
+def ready():
+    return True
+
+
+class PasswordHasher:
+    """
+    bcrypt in a small pool of worker processes. At most `workers` hashes run at once,
+    so logins never take more cores than that away from inference, and up to
+    `max_queued` more wait; beyond that calls raise PasswordsBusy instead of piling up.
+    A worker that dies breaks the pool: it is rebuilt and the call retried once, and if
+    that fails too the hash runs in the calling thread.
+    """
+
+    def __init__(self, workers=2, max_queued=32, rounds=DEFAULT_ROUNDS):
+        self.rounds = rounds
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(workers + max_queued)
+        # Fork while the server has no threads yet, so workers do not re-import the detector stack
+        methods = mp.get_all_start_methods()
+        self.ctx = mp.get_context("fork" if "fork" in methods else "spawn")
+        self.lock = threading.Lock()
+        self.pool = ProcessPoolExecutor(workers, mp_context=self.ctx)
+        self.pool.submit(ready).result()
+        print(f"[Passwords] {workers} bcrypt workers, cost {rounds}")
+
+    def rebuild(self, broken):
+        # Every call that saw the broken pool gets here, only the first one replaces it
+        with self.lock:
+            if self.pool is broken:
+                print("[Passwords] worker pool broken, starting a new one")
+                broken.shutdown(wait=False)
+                self.pool = ProcessPoolExecutor(self.workers, mp_context=self.ctx)
+            return self.pool
+
+    def run(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            raise PasswordsBusy()
+        try:
+            pool = self.pool
+            try:
+                return pool.submit(fn, *args).result()
+            except BrokenProcessPool:
+                pool = self.rebuild(pool)
+            try:
+                return pool.submit(fn, *args).result()
+            except BrokenProcessPool:
+                print("[Passwords] worker pool broken again, hashing inline")
+                return fn(*args)
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self.run(hash_password, password, self.rounds)
+
+    def check(self, password, pw_hash):
+        return self.run(check_password, password, pw_hash, self.rounds)
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,131 @@
+import threading
+
+MAX_FPS = 15            # defaults for clients that do not say what they upload
+MAX_QUALITY = 30
+MIN_FPS = 3
+MIN_QUALITY = 15
+INTERVAL = 1.0          # seconds of measurements behind each decision
+DROP_LIMIT = 0.2        # fraction of uploads replaced before the game loop got to them
+STARVED_LIMIT = 0.5     # fraction of ticks the client spent out of upload credit, waiting on the server
+ARRIVAL_LIMIT = 0.8     # uploads arriving below this fraction of the asked rate mean the uplink is full
+KEEP_PACE = 0.9         # the rate is only raised while uploads arrive at this fraction of it or better
+LINK_FULL = 0.8         # the uplink counts as full while it carries this fraction of the most it has carried
+LINK_DECAY = 0.95       # per interval, so the remembered best follows a link that got slower
+PROCESS_BUDGET = 0.5    # seconds per second the game loop may spend on one player's frames
+
+
+class RateController:
+    """
+    Upload frame rate and JPEG quality for one player, adjusted once per interval from
+    what the server measured:
+      - processing: uploads are replaced before the game loop gets to them, the
+        client keeps running out of credit, or the frames asked for would take more
+        than PROCESS_BUDGET of game loop time -> lower the frame rate to what the room
+        can process
+      - downlink: the player's outbox is dropping frames -> lower the frame rate
+      - uplink: uploads arrive well below the asked rate while the link carries about
+        the most it has ever carried -> lower quality first (smaller frames), then the
+        frame rate to what arrives
+      - short arrivals on a link with room to spare (a slow camera, a client waiting
+        on credit) -> the frame rate to what arrives, quality is left alone
+      - otherwise step back up towards what the client asked for, as far as the
+        processing budget allows.
+    update() returns the new (fps, quality) when it changed, else None.
+    """
+
+    def __init__(self, max_fps=MAX_FPS, max_quality=MAX_QUALITY, min_fps=MIN_FPS, min_quality=MIN_QUALITY):
+        self.max_fps = max_fps
+        self.max_quality = max_quality
+        self.min_fps = min(min_fps, max_fps)
+        self.min_quality = min(min_quality, max_quality)
+        self.fps = max_fps
+        self.quality = max_quality
+        self.lock = threading.Lock()
+        self.started = None
+        self.uploads = 0
+        self.upload_bytes = 0
+        self.frames = 0
+        self.busy = 0.0
+        self.dropped = 0
+        self.outbox_dropped = 0
+        self.ticks = 0
+        self.starved = 0
+        self.settle = 0
+        self.link_rate = 0.0   # upload bytes per second over the last interval
+        self.link_best = 0.0   # decaying maximum of link_rate
+        self.frame_seconds = 0.0   # mean game loop time per processed upload
+
+    def observe_upload(self, nbytes):
+        with self.lock:
+            self.uploads += 1
+            self.upload_bytes += nbytes
+
+    def observe_frame(self, seconds):
+        with self.lock:
+            self.frames += 1
+            self.busy += seconds
+
+    def observe_tick(self, starved):
+        # Game loop only: whether the client had no upload credit left this tick
+        self.ticks += 1
+        self.starved += starved
+
+    def update(self, now, dropped, outbox_dropped):
+        """
+        dropped and outbox_dropped are the player's running totals of uploads replaced
+        before processing and frames the outbox gave up on.
+        """
+        if self.started is None:
+            self.started, self.dropped, self.outbox_dropped = now, dropped, outbox_dropped
+            return None
+        elapsed = now - self.started
+        if elapsed < INTERVAL:
+            return None
+        with self.lock:
+            uploads, upload_bytes, frames, busy = self.uploads, self.upload_bytes, self.frames, self.busy
+            self.uploads = self.upload_bytes = self.frames = 0
+            self.busy = 0.0
+        ticks, starved = self.ticks, self.starved
+        self.ticks = self.starved = 0
+        new_drops, self.dropped = dropped - self.dropped, dropped
+        new_outbox_drops, self.outbox_dropped = outbox_dropped - self.outbox_dropped, outbox_dropped
+        self.started = now
+        if self.settle:
+            # The client is still switching to the last setting, these numbers are stale
+            self.settle -= 1
+            return None
+
+        fps, quality = self.fps, self.quality
+        arrival = uploads / elapsed
+        self.link_rate = upload_bytes / elapsed
+        self.frame_seconds = busy / frames if frames else 0.0
+        link_full = self.link_best > 0 and self.link_rate >= LINK_FULL * self.link_best
+        self.link_best = max(self.link_rate, self.link_best * LINK_DECAY)
+        # Frames per second the game loop can take from this player within its budget
+        affordable = int(PROCESS_BUDGET / self.frame_seconds) if self.frame_seconds else self.max_fps
+        if (uploads and new_drops / uploads > DROP_LIMIT) or (ticks and starved / ticks > STARVED_LIMIT):
+            fps = max(self.min_fps, min(int(frames / elapsed), affordable, fps - 1))
+        elif affordable < fps:
+            fps = max(self.min_fps, affordable)
+        elif new_outbox_drops:
+            fps = max(self.min_fps, int(fps * 0.75))
+        elif arrival < ARRIVAL_LIMIT * fps:
+            if link_full and not starved and quality > self.min_quality:
+                quality = max(self.min_quality, int(quality * 0.8))
+            else:
+                fps = max(self.min_fps, int(arrival))
+        else:
+            # Nothing is struggling: quality back up, and the rate too while the client keeps pace with it
+            quality = min(self.max_quality, quality + 5)
+            if arrival >= KEEP_PACE * fps and fps + 1 <= affordable:
+                fps = min(self.max_fps, fps + 1)
+
+        if (fps, quality) == (self.fps, self.quality):
+            return None
+        self.fps, self.quality = fps, quality
+        self.settle = 1
+        return fps, quality
+
+    def stats(self):
+        return {'fps': self.fps, 'quality': self.quality, 'link_rate': self.link_rate,
+                'frame_seconds': self.frame_seconds}
@@ -0,0 +1,167 @@
+import sys
+import json
+import time
+import struct
+import argparse
+import threading
+import numpy as np
+import Detector
+import Utils
+
+MAGIC = b"RLGL1\n"
+RECORD = struct.Struct(">cdH")      # kind, timestamp, length of the username that follows
+FRAME = struct.Struct(">?IdI")      # win flag, sequence number, capture time, JPEG length
+LIGHT = struct.Struct(">?")         # red light on
+
+
+class SessionRecorder:
+    """
+    Appends what a GameRoom receives to one file: every uploaded JPEG as it arrived
+    (not re-encoded) with its win flag and sequence number, and every light change.
+    Safe to call from the room's receive threads and its game loop at the same time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+
+    def write(self, kind, user, body):
+        name = user.encode()
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(RECORD.pack(kind, time.time(), len(name)) + name)
+            self.file.write(body)
+
+    def record_frame(self, user, win_flag, seq, capture_ts, jpeg):
+        self.write(b"F", user, FRAME.pack(win_flag, seq, capture_ts, len(jpeg)) + bytes(jpeg))
+
+    def record_light(self, red_light):
+        self.write(b"L", "", LIGHT.pack(red_light))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_session(path):
+    """
+    Yields ('frame', timestamp, user, (win_flag, seq, capture_ts, jpeg)) and
+    ('light', timestamp, '', red_light) in recorded order.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a session recording")
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            kind, timestamp, name_len = RECORD.unpack(head)
+            user = f.read(name_len).decode()
+            if kind == b"F":
+                win_flag, seq, capture_ts, size = FRAME.unpack(f.read(FRAME.size))
+                yield 'frame', timestamp, user, (win_flag, seq, capture_ts, f.read(size))
+            elif kind == b"L":
+                yield 'light', timestamp, user, LIGHT.unpack(f.read(LIGHT.size))[0]
+            else:
+                raise ValueError(f"Unknown record {kind!r} in {path}")
+
+
+def percentiles(values):
+    if not values:
+        return {'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0}
+    values = np.array(values) * 1000
+    return {'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)), 'p99': float(np.percentile(values, 99))}
+
+
+def replay(path, users=None, **game_options):
+    """
+    Feeds a recording through one Game per player as fast as possible. Time inside the
+    replay is the recorded clock, so light changes land between the same frames as they
+    did live. Returns per-frame latency, detector and tracker time in milliseconds and
+    the elimination timeline.
+    """
+    from GameLogic import Game
+
+    games, known = {}, {}
+    latency, detect, track = [], [], []
+    timeline = []
+    start = None
+    for kind, timestamp, user, body in read_session(path):
+        start = timestamp if start is None else start
+        clock = timestamp - start
+        if kind == 'light':
+            for game in games.values():
+                game.change_light()
+            timeline.append({'t': clock, 'event': 'red light' if body else 'green light'})
+            continue
+        if users and user not in users:
+            continue
+        game = games.get(user)
+        if game is None:
+            game = games[user] = Game(**game_options)
+            known[user] = {}
+        if not game.active:
+            continue
+
+        win_flag, seq, capture_ts, jpeg = body
+        began = time.perf_counter()
+        frame, source_scale = Utils.decode_upload(jpeg, Detector.INPUT_SIZE)
+        game.update_values(frame, win_flag, source_scale=source_scale)
+        latency.append(time.perf_counter() - began)
+        detect.append(game.timing['detect'])
+        track.append(game.timing['track'])
+
+        # Registrations and eliminations since the previous frame
+        for player_id, alive in zip(game.players.players['id'].tolist(), game.players.players['alive'].tolist()):
+            before = known[user].get(player_id)
+            if before is None:
+                timeline.append({'t': clock, 'user': user, 'player': player_id, 'event': 'registered'})
+            elif before and not alive:
+                timeline.append({'t': clock, 'user': user, 'player': player_id, 'event': 'eliminated'})
+            known[user][player_id] = alive
+        if not game.active:
+            timeline.append({'t': clock, 'user': user, 'event': 'won' if game.winner is not None else 'lost',
+                             'player': game.winner})
+
+    for game in games.values():
+        game.close()
+    return {'recording': path, 'frames': len(latency), 'latency_ms': percentiles(latency),
+            'detect_ms': percentiles(detect), 'track_ms': percentiles(track),
+            'players': {user: game.stats() for user, game in games.items()}, 'timeline': timeline}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded game session through GameLogic.Game")
+    parser.add_argument("recording")
+    parser.add_argument("--user", action="append", help="only replay this player (repeatable)")
+    parser.add_argument("--backend", default=Detector.DEFAULT_BACKEND, choices=sorted(Detector.BACKENDS))
+    parser.add_argument("--weights", default=Detector.DEFAULT_WEIGHTS)
+    parser.add_argument("--tracker", default="deepsort")
+    parser.add_argument("--detect-interval", type=int, default=1)
+    parser.add_argument("--motion-threshold", type=float, default=0.002)
+    parser.add_argument("--json", help="write the full report to this file")
+    args = parser.parse_args()
+
+    report = replay(args.recording, args.user, weights=args.weights, backend=args.backend, tracker=args.tracker,
+                    detect_interval=args.detect_interval, motion_threshold=args.motion_threshold)
+    lat, det, trk = report['latency_ms'], report['detect_ms'], report['track_ms']
+    print(f"{report['frames']} frames: {lat['mean']:.1f} ms mean, p95 {lat['p95']:.1f} ms, p99 {lat['p99']:.1f} ms "
+          f"(detector {det['mean']:.1f} ms, tracker {trk['mean']:.1f} ms)")
+    for event in report['timeline']:
+        who = f" {event['user']}" if 'user' in event else ""
+        player = f" player {event['player']}" if event.get('player') is not None else ""
+        print(f"  {event['t']:7.2f}s{who}{player} {event['event']}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
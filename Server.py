@@ -1,64 +1,130 @@
 
-import socket, threading, struct, time, random, string, cv2, numpy as np, sqlite3, json, bcrypt
-from GameLogic import Game
+import socket, threading, queue, time, random, string, os, cv2, sqlite3, json
+from GameLogic import Game, TRACKERS
+import Datagrams
+import Detector
+import InferenceService
+import Metrics
+import Overlay
+import Passwords
+import RateControl
+import Replay
 import Utils
 HOST = '0.0.0.0'
 PORT = 5000
 MAX_PLAYERS = 1
 TICK = 0.05
+DETECTOR_BACKEND = Detector.DEFAULT_BACKEND   # ultralytics, onnxruntime or opencv (see Detector.py bench)
+DETECTOR_WEIGHTS = Detector.DEFAULT_WEIGHTS   # .pt for ultralytics, .onnx from Detector.py export otherwise
+BATCH_WINDOW = 0.01     # seconds the inference scheduler waits to fill a batch
+MAX_BATCH_SIZE = 8      # frames per detector call, across all rooms
+DETECT_INTERVAL = 1     # default frames per detector run, moving or not; rooms can ask for more in create_game
+MAX_DETECT_INTERVAL = 30  # the most frames a room may go between detector runs
+MOTION_THRESHOLD = 0.002  # changed-pixel fraction below which a frame skips the detector, 0 disables the gate
+TRACKER = "deepsort"    # default tracker, "iou" skips the appearance embedder
+INFERENCE_WORKERS = 0   # > 0 runs detection in that many worker processes instead of in this one
+STAGE_QUEUE_SIZE = 8    # frames waiting between two pipeline stages of a room
+SPECTATORS = None       # pipeline key for the spectator grid
+DOWNSTREAMS = ("frames", "annotations")   # what players receive: annotated JPEGs, or boxes the client draws
+MAX_UPLOAD_FPS = 30     # the most a client may ask to upload; the rate controller works below what it asked
+MAX_UPLOAD_QUALITY = 95
+CREDIT_WINDOW = 2       # uploads a player may have in flight; each one consumed is credited back
+OUTBOX_FRAMES = 2       # video frames waiting for one connection before the oldest is dropped
+DATAGRAM_PORT = None    # UDP port players may upload frames to instead of TCP (see Datagrams.py), None disables
+RECORD_DIR = None       # folder to record every room's uploads into, for Replay.py
+HANDSHAKE_WORKERS = 16  # connections going through key exchange and login at the same time
+HANDSHAKE_QUEUE = 64    # accepted connections waiting for a handshake worker, more are refused
+KEY_EXCHANGE_TIMEOUT = 5  # seconds for the client to answer with its AES key
+LOGIN_TIMEOUT = 120     # seconds for each login attempt, the user is typing
+BCRYPT_ROUNDS = Passwords.DEFAULT_ROUNDS  # cost of new hashes, stored hashes are upgraded at login
+BCRYPT_WORKERS = 2      # processes hashing passwords, the most cores logins can take from inference
+BCRYPT_QUEUE = 32       # password checks allowed to wait for a worker, beyond that logins are told to retry
+METRICS_PORT = None     # local port for Prometheus metrics (http://127.0.0.1:PORT/metrics), None disables
+ASYNC_CORE = True       # serve connections on asyncio (AsyncServer.py); False for a thread per client
 
 
 
 class GameRoom:
 
-    def __init__(self, light_duration, max_players):
-        self.users = {}   # username -> { 'game':Game(), 'sock':socket, 'aes_key':bytes, 'frame':None, 'active':True }
-        self.spectators = []
+    def __init__(self, light_duration, max_players, scheduler=None, detect_interval=DETECT_INTERVAL,
+                 motion_threshold=MOTION_THRESHOLD, tracker=TRACKER):
+        self.users = {}   # username -> { 'game':Game(), 'sock':socket, 'aes_key':bytes, 'out':Outbox, 'frame':None, 'seq':int, 'active':True, ... }
+        self.spectators = []   # Outbox per spectator
         self.max_players = max_players
         self.room_id = self.generate_game_id(5)
         self.lock = threading.Lock()
         self.winner = None
+        self.ended = False
         self.red_light = False
         self.light_duration = light_duration
         self.start_time = None
+        self.scheduler = scheduler
+        self.detect_interval = detect_interval
+        self.motion_threshold = motion_threshold
+        self.tracker = tracker
+        # Pipeline: game_loop (detect, track, annotate) -> encode_loop -> send_loop
+        self.encode_queue = Utils.LatestQueue(STAGE_QUEUE_SIZE)
+        self.send_queue = Utils.LatestQueue(STAGE_QUEUE_SIZE)
+        self.stages = []
+        self.channels = {}   # user -> (Server.channels, channel) for players uploading datagrams
+        self.recorder = None
+        if RECORD_DIR:
+            path = os.path.join(RECORD_DIR, f"{self.room_id}-{int(time.time())}.rlgl")
+            self.recorder = Replay.SessionRecorder(path)
 
     def generate_game_id(self, length):
         characters = string.ascii_letters + string.digits
         return ''.join(random.choice(characters) for _ in range(length))
 
-    def add_player(self, user, sock, aes_key, role):
+    def add_player(self, user, sock, aes_key, role, start_reader=True, downstream="frames",
+                   max_fps=RateControl.MAX_FPS, max_quality=RateControl.MAX_QUALITY):
+        # Borrow the shared detector before taking the room lock.
+        # start_reader=False leaves reading the player's uploads to the caller (see handle_upload)
+        game = Game(self.scheduler, detect_interval=self.detect_interval,
+                    motion_threshold=self.motion_threshold, tracker=self.tracker) if role == 'player' else None
         with self.lock:
             if role == 'player':
-                game = Game()
-                self.users[user] = {'game': game, 'sock': sock, 'aes': aes_key,'frame': None, 'active': True}
+                self.users[user] = {'game': game, 'sock': sock, 'aes': aes_key, 'out': self.outbox(sock, aes_key, user),
+                                    'frame': None, 'active': True, 'downstream': downstream,
+                                    'seq': 0, 'claimed': 0, 'processed_seq': 0, 'capture_ts': 0.0,
+                                    'duplicates': 0, 'dropped': 0, 'received': 0, 'consumed': 0, 'credited': 0, 'lost': 0,
+                                    'rate': RateControl.RateController(max_fps, max_quality)}
                 print(f"{user} has joined the game")
-                threading.Thread(target=self.recv_loop, args=(user, ), daemon=True).start()
+                if start_reader:
+                    threading.Thread(target=self.recv_loop, args=(user, ), daemon=True).start()
                 if len(self.users) == self.max_players:
                     threading.Thread(target=self.game_loop, daemon=True).start()
                 return True
             elif role == 'spectator':
-                self.spectators.append((sock, aes_key))
+                self.spectators.append(self.outbox(sock, aes_key, "spectators"))
                 print(f"[GameRoom {self.room_id}] A spectator joined.")
                 return True
             return False
 
+    def outbox(self, sock, aes_key, label):
+        def observe(seconds):
+            # The final result is still being written after the room's metrics are dropped
+            if not self.ended:
+                Metrics.stage_seconds.observe(seconds, self.room_id, label, 'send')
+        # Connections that bring their own queue (AsyncPeer) drain it without a thread each
+        if hasattr(sock, "outbox"):
+            return sock.outbox(aes_key, OUTBOX_FRAMES, observe)
+        return Utils.Outbox(sock, aes_key, OUTBOX_FRAMES, observe)
+
+    def outboxes(self):
+        # (label, Outbox) for every connection in the room
+        with self.lock:
+            return ([(user, info['out']) for user, info in self.users.items()] +
+                    [(f"spectator-{i}", outbox) for i, outbox in enumerate(self.spectators)])
 
 
     def recv_loop(self, user):
-        game = self.users[user]['game']
-        aes = self.users[user]['aes']
-        sock = self.users[user]['sock']
+        # Uploads land in one reused buffer; handle_upload is done with each before the next arrives
+        reader = Utils.FrameReader(self.users[user]['sock'], self.users[user]['aes'])
         active = self.users[user]['active']
         try:
             while active and self.winner is None:
-                plaintext = Utils.recv_encrypted(sock, aes)
-                win_flag = plaintext[0]
-                payload = plaintext[1:]
-                arr = np.frombuffer(payload, np.uint8)
-                frame = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-                with self.lock:
-                    self.users[user]['frame'] = (frame, win_flag)
-                    active = self.users[user]['active']
+                active = self.handle_upload(user, reader.read())
             print("Success")
 
         except (ConnectionAbortedError, ConnectionResetError):
@@ -67,28 +133,160 @@ class GameRoom:
         except Exception as e:
             print(f"[recv_loop] unexpected error for player {user}:", e)
         finally:
-            with self.lock:
-                game.active = False
+            self.player_left(user)
+
+    def handle_upload(self, user, plaintext):
+        """
+        Takes one decrypted upload from a player: header check, recording and decode.
+        Returns whether the player is still in the game.
+        """
+        win_flag, seq, capture_ts = Utils.UPLOAD_HEADER.unpack_from(plaintext)
+        info = self.users[user]
+        Metrics.uploads.inc(self.room_id, user)
+        info['rate'].observe_upload(len(plaintext))
+        # TCP and datagram uploads of one player can arrive on two threads: claim the sequence
+        # number under the lock, so each upload is decoded once
+        with self.lock:
+            info['received'] += 1
+            if seq <= info['claimed']:
+                # Repeated or out-of-order upload, not worth decoding
+                info['duplicates'] += 1
+                info['consumed'] += 1
+                duplicate = True
+            else:
+                lost = seq - info['claimed'] - 1
+                if lost > 0:
+                    # Datagram uploads that never arrived still free their credit
+                    info['lost'] += lost
+                    info['consumed'] += lost
+                info['claimed'] = seq
+                duplicate = False
+        if duplicate:
+            Metrics.duplicates.inc(self.room_id, user)
+            return info['active']
+        payload = memoryview(plaintext)[Utils.UPLOAD_HEADER.size:]
+        if self.recorder is not None:
+            self.recorder.record_frame(user, win_flag, seq, capture_ts, payload)
+        # Decode straight to the smallest scale that still covers the network input
+        start = time.perf_counter()
+        frame, source_scale = Utils.decode_upload(payload, Detector.INPUT_SIZE)
+        Metrics.stage_seconds.observe(time.perf_counter() - start, self.room_id, user, 'decode')
+        with self.lock:
+            if seq < info['seq'] or info['seq'] > info['processed_seq']:
+                # A newer upload finished decoding first, or the previous frame was never processed
+                info['dropped'] += 1
+                info['consumed'] += 1
+                Metrics.dropped.inc(self.room_id, user)
+                if seq < info['seq']:
+                    return info['active']
+            info['frame'] = (frame, win_flag, source_scale)
+            info['seq'], info['capture_ts'] = seq, capture_ts
+            return info['active']
+
+    def player_left(self, user):
+        # The player's connection stopped delivering uploads
+        with self.lock:
+            self.users[user]['game'].active = False
+        self.close_channel(user)
+        Metrics.forget(self.room_id, user)
+
+    def open_channel(self, user, channels, channel, receiver):
+        # Registers the player's datagram channel in the server's table, removed again by close_channel
+        with self.lock:
+            channels[channel] = (self, user, receiver)
+            self.channels[user] = (channels, channel)
+
+    def close_channel(self, user):
+        with self.lock:
+            entry = self.channels.pop(user, None)
+        if entry is None:
+            return
+        channels, channel = entry
+        _, _, receiver = channels.pop(channel, (None, None, None))
+        if receiver is not None:
+            stats = receiver.stats()
+            print(f"[Server] {user}: {stats['frames']} datagram frames, {stats['incomplete']} incomplete, "
+                  f"{stats['late']} late fragments, {stats['rejected']} rejected")
+
+    def start_pipeline(self):
+        self.stages = [threading.Thread(target=self.encode_loop, daemon=True),
+                       threading.Thread(target=self.send_loop, daemon=True)]
+        for stage in self.stages:
+            stage.start()
+
+    def stop_pipeline(self):
+        # Let the stages drain in order, so nothing queued is sent after the final result
+        self.encode_queue.close()
+        self.stages[0].join()
+        self.send_queue.close()
+        self.stages[1].join()
+
+    def pipeline_stats(self):
+        return {'encode': self.encode_queue.stats(), 'send': self.send_queue.stats()}
+
+    def encode_loop(self):
+        while True:
+            item = self.encode_queue.get()
+            if item is None:
+                break
+            key, (header, frame) = item
+            start = time.perf_counter()
+            success, jpg = cv2.imencode('.jpg', frame)
+            Metrics.stage_seconds.observe(time.perf_counter() - start, self.room_id, self.label(key), 'encode')
+            if success:
+                self.send_queue.put(key, header + jpg.tobytes())
+
+    def send_loop(self):
+        while True:
+            item = self.send_queue.get()
+            if item is None:
+                break
+            key, plaintext = item
+            # Each connection's writer encrypts and sends; a slow one drops its own old frames
+            targets = list(self.spectators) if key is SPECTATORS else [self.users[key]['out']]
+            for outbox in targets:
+                outbox.send_frame(plaintext)
+
+    def label(self, key):
+        # Metrics label for a pipeline key
+        return "spectators" if key is SPECTATORS else key
 
     def game_loop(self):
         print(f"game started")
         self.start_time = time.time()
+        self.start_pipeline()
         while True:
             self.change_light()
             time.sleep(TICK)
             with self.lock:
-                # 1) Process each player
-                alive_frames = []
+                # 1) Queue every player's frame for detection so they share one batch
+                #    (None when the player's tracker carries this frame on its own)
+                requests = {}
                 for user, info in list(self.users.items()):
+                    # Players are skipped when nothing new arrived, so pick up player_left here:
+                    # a player who disconnected never sends the frame that would mark them out
+                    info['active'] = info['active'] and info['game'].active
                     if not info['active']:
-                        break
-                    game = info['game']
-                    sock = info['sock']
-                    aes = info['aes']
-                    if info['frame'] is None:
                         continue
-                    frame, win_flag = info['frame']
-                    frame = game.update_values(frame, win_flag)
+                    if info['frame'] is None or info['seq'] == info['processed_seq']:
+                        continue   # nothing new from this player since the last tick
+                    info['processed_seq'] = info['seq']
+                    info['consumed'] += 1
+                    requests[user] = info['game'].request_detections(info['frame'][0])
+
+                # 2) Process each player, encoding and sending happen in the later stages
+                alive_frames = []
+                for user, request in requests.items():
+                    info = self.users[user]
+                    game = info['game']
+                    frame, win_flag, source_scale = info['frame']
+                    # Annotation-only players get boxes to draw themselves, unless spectators need the picture
+                    draw = info['downstream'] == "frames" or bool(self.spectators)
+                    start = time.perf_counter()
+                    frame = game.update_values(frame, win_flag, request, draw, source_scale)
+                    elapsed = time.perf_counter() - start
+                    self.observe_update(user, elapsed, game.timing)
+                    info['rate'].observe_frame(elapsed)
                     alive = game.active
                     info['active'] = alive
                     self.winner = game.winner
@@ -96,61 +294,115 @@ class GameRoom:
                     if self.winner is not None:
                         self.winner = (user, self.winner)
                         break
-                    success, jpg = cv2.imencode('.jpg', frame)
-                    if not success:
-                        return
-                    buffer = jpg.tobytes()
-                    plaintext = struct.pack(">???", True, alive, self.red_light) + buffer
-                    Utils.send_encrypted(sock, aes, plaintext)
+                    if info['downstream'] == "annotations":
+                        # No encode stage: a few hundred bytes straight to the player's outbox
+                        header = Utils.DOWNSTREAM_HEADER.pack(True, alive, self.red_light, Utils.DOWNSTREAM_ANNOTATIONS)
+                        info['out'].send_frame(header + json.dumps(game.annotations(), separators=(",", ":")).encode())
+                    else:
+                        header = Utils.DOWNSTREAM_HEADER.pack(True, alive, self.red_light, Utils.DOWNSTREAM_FRAME)
+                        self.encode_queue.put(user, (header, frame))
                     # Check if player lost
                     if alive:
                         alive_frames.append(frame)
 
-                # 2) Check for winner or lost
+                # 3) Credit back what was consumed, and pass on rate or quality changes
+                if self.winner is None:
+                    self.send_controls()
+
+                # 4) Check for winner or lost
                 alive_ids = [game_id for game_id, info in self.users.items() if info['active'] == True]
                 if self.winner is not None or not alive_ids:
                     for info in self.users.values():
                         info['active'] = False
                     break
 
-                if alive_frames:
-                    from math import ceil
-                    cols = min(len(alive_frames), 3)  # up to 3 columns
-                    rows = ceil(len(alive_frames) / cols)
-                    grid = Utils.stack_frames(alive_frames, grid_size=(rows, cols))
-                    success, jpg = cv2.imencode('.jpg', frame)
-                    if not success:
-                        return
-                    buffer = jpg.tobytes()
-                    plaintext = struct.pack(">???", True, True, self.red_light) + buffer
-                    for sock, aes in self.spectators:
-                        Utils.send_encrypted(sock, aes, plaintext)
+            if alive_frames and self.spectators:
+                from math import ceil
+                cols = min(len(alive_frames), 3)  # up to 3 columns
+                rows = ceil(len(alive_frames) / cols)
+                grid = Utils.stack_frames(alive_frames, grid_size=(rows, cols))
+                header = Utils.DOWNSTREAM_HEADER.pack(True, True, self.red_light, Utils.DOWNSTREAM_FRAME)
+                self.encode_queue.put(SPECTATORS, (header, grid))
+
+        self.stop_pipeline()
+        if self.recorder is not None:
+            self.recorder.close()
+        stats = self.pipeline_stats()
+        print(f"[GameRoom {self.room_id}] pipeline drops: encode {stats['encode']['drops']}, "
+              f"send {stats['send']['drops']}")
 
         # game ended, send final result frames once more
         # overlay result on the last out frame
-        frame = 255 * np.ones((200, 640, 3), np.uint8)
         text = f"Winner: player {self.winner[1]} from  {self.winner[0]}'s game" if self.winner else "Everyone Lost"
-        cv2.putText(frame, text, (20, 100), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (255, 0, 0), 3)
+        frame = Overlay.cache.end_screen(text, (200, 640), (255, 0, 0))
         success, jpg = cv2.imencode('.jpg', frame)
         if not success:
             return
         buffer = jpg.tobytes()
-        plaintext = struct.pack(">???", False, False, self.red_light) + buffer
+        plaintext = Utils.DOWNSTREAM_HEADER.pack(False, False, self.red_light, Utils.DOWNSTREAM_FRAME) + buffer
+        result = {'players': [], 'red_light': self.red_light, 'result': text}
+        annotated = (Utils.DOWNSTREAM_HEADER.pack(False, False, self.red_light, Utils.DOWNSTREAM_ANNOTATIONS) +
+                     json.dumps(result).encode())
         conn = sqlite3.connect("Users.db")
         c = conn.cursor()
-        for info in self.users.values():
-            Utils.send_encrypted(info['sock'], info['aes'], plaintext)
+        for user, info in self.users.items():
+            info['out'].send(annotated if info['downstream'] == "annotations" else plaintext)
             won = int(self.winner is not None and self.winner[0] == user)
             c.execute("INSERT INTO results(username, won) VALUES (?, ?)", (user, won))
         conn.commit()
         conn.close()
-        for spec, aes in self.spectators:
-            Utils.send_encrypted(sock, aes, plaintext)
+        for user, info in self.users.items():
+            stats = info['game'].stats()
+            print(f"[GameRoom {self.room_id}] {user}: {stats['frames']} frames, "
+                  f"{stats['detections']} detections, {stats['skip_rate']:.0%} skipped by the motion gate, "
+                  f"{info['dropped']} dropped, {info['duplicates']} duplicates, {info['lost']} lost, "
+                  f"{info['out'].stats()['dropped']} not sent")
+            info['game'].close()
+        for outbox in self.spectators:
+            outbox.send(plaintext)
+        # Writers finish what is queued, the final result included, then exit
+        for _, outbox in self.outboxes():
+            outbox.close()
+        for user in list(self.users):
+            self.close_channel(user)
+        self.ended = True
+        Metrics.forget(self.room_id)
+
+    def send_controls(self):
+        # Called with the room lock held; at most one small message per player and tick
+        now = time.time()
+        for user, info in self.users.items():
+            if not info['active']:
+                continue
+            control = {}
+            info['rate'].observe_tick(info['received'] >= info['credited'] + CREDIT_WINDOW)
+            # Every upload processed, replaced or repeated frees a slot in the player's window
+            if info['consumed'] > info['credited']:
+                control["credit"] = info['consumed'] - info['credited']
+                info['credited'] = info['consumed']
+            change = info['rate'].update(now, info['dropped'], info['out'].stats()['dropped'])
+            if change is not None:
+                control["fps"], control["quality"] = change
+                print(f"[GameRoom {self.room_id}] {user}: upload at {change[0]} fps, JPEG quality {change[1]}")
+            if control:
+                self.send_control(info, control)
+
+    def send_control(self, info, control):
+        header = Utils.DOWNSTREAM_HEADER.pack(True, info['active'], self.red_light, Utils.DOWNSTREAM_CONTROL)
+        info['out'].send(header + json.dumps(control).encode())
+
+    def observe_update(self, user, elapsed, timing):
+        Metrics.stage_seconds.observe(elapsed, self.room_id, user, 'update')
+        for stage in ('detect', 'track', 'annotate'):
+            if timing.get(stage):
+                Metrics.stage_seconds.observe(timing[stage], self.room_id, user, stage)
 
     def change_light(self):
         elapsed_time = time.time() - self.start_time
         if elapsed_time > self.light_duration:
             self.red_light = not self.red_light
+            if self.recorder is not None:
+                self.recorder.record_light(self.red_light)
             for game_id, info in list(self.users.items()):
                 game = info['game']
                 game.change_light()  # Toggle game state
@@ -166,6 +418,110 @@ class Server:
         self.users = {}   # username -> socket
         self.gameRooms = {}   # room_id  -> GameRoom instance
         self.server_private, self.server_public = Utils.generate_rsa_keypair()
+        self.handshakes = queue.Queue(HANDSHAKE_QUEUE)   # (sock, addr, accepted at)
+        self.handshakes_busy = 0
+        self.handshakes_waiting = 0   # connections the asyncio core has waiting for a handshake slot
+        self.handshake_lock = threading.Lock()
+        # Before anything below starts a thread, the pool forks its workers
+        self.passwords = Passwords.PasswordHasher(BCRYPT_WORKERS, BCRYPT_QUEUE, BCRYPT_ROUNDS)
+        if INFERENCE_WORKERS > 0:
+            self.scheduler = InferenceService.InferenceService(INFERENCE_WORKERS, DETECTOR_WEIGHTS, DETECTOR_BACKEND)
+        else:
+            self.scheduler = Detector.InferenceScheduler(DETECTOR_WEIGHTS, DETECTOR_BACKEND,
+                                                         batch_window=BATCH_WINDOW, max_batch_size=MAX_BATCH_SIZE)
+        self.channels = {}   # datagram channel -> (room, user, Datagrams.DatagramReceiver)
+        if DATAGRAM_PORT is not None:
+            threading.Thread(target=self.datagram_loop, daemon=True).start()
+        if METRICS_PORT is not None:
+            self.register_metrics()
+            Metrics.serve(METRICS_PORT)
+
+    def register_metrics(self):
+        # Gauges read their state on scrape, nothing here runs per frame
+        def scheduler(field):
+            def read():
+                stats = self.scheduler.stats()
+                if isinstance(stats, dict):
+                    return [((), stats[field])] if field in stats else []
+                return []
+            return read
+
+        def workers(field):
+            def read():
+                stats = self.scheduler.stats()
+                if isinstance(stats, list):
+                    return [((str(worker['pid']), ), worker[field]) for worker in stats]
+                return []
+            return read
+
+        def pipeline(stage, field):
+            def read():
+                return [((room_id, ), room.pipeline_stats()[stage][field]) for room_id, room in list(self.gameRooms.items())]
+            return read
+
+        def players(read_value):
+            def read():
+                samples = []
+                for room_id, room in list(self.gameRooms.items()):
+                    for user, info in list(room.users.items()):
+                        samples.append(((room_id, user), read_value(info)))
+                return samples
+            return read
+
+        def models(field):
+            def read():
+                return [((row['backend'], row['weights']), row[field]) for row in Detector.registry.report()]
+            return read
+
+        gauge = Metrics.registry.gauge
+        gauge("rlgl_scheduler_batches", "Detector calls made by the inference scheduler", (), scheduler('batches'))
+        gauge("rlgl_scheduler_frames", "Frames detected by the inference scheduler", (), scheduler('frames'))
+        gauge("rlgl_scheduler_mean_batch", "Mean frames per detector call", (), scheduler('mean_batch'))
+        gauge("rlgl_scheduler_occupancy", "Mean batch size over the maximum batch size", (), scheduler('occupancy'))
+        gauge("rlgl_scheduler_queued", "Frames waiting for the detector", (), scheduler('queued'))
+        # Models loaded in this process; with INFERENCE_WORKERS they live in the workers instead
+        gauge("rlgl_model_bytes", "Memory held by a loaded detector's weights", ("backend", "weights"),
+              models('bytes'))
+        gauge("rlgl_model_refs", "Games sharing a loaded detector", ("backend", "weights"), models('refs'))
+        gauge("rlgl_model_mean_ms", "Mean detector latency per frame", ("backend", "weights"), models('mean_ms'))
+        gauge("rlgl_worker_inflight", "Frames inside an inference worker", ("pid", ), workers('inflight'))
+        gauge("rlgl_worker_processed", "Frames processed by an inference worker", ("pid", ), workers('processed'))
+        for stage in ('encode', 'send'):
+            gauge(f"rlgl_{stage}_queue_depth", f"Items waiting for the {stage} stage", ("room", ),
+                  pipeline(stage, 'depth'))
+            gauge(f"rlgl_{stage}_queue_drops", f"Items the {stage} queue replaced before they were taken",
+                  ("room", ), pipeline(stage, 'drops'))
+        gauge("rlgl_skip_rate", "Fraction of frames the motion gate served without detection", ("room", "player"),
+              players(lambda info: info['game'].stats()['skip_rate']))
+        gauge("rlgl_player_active", "1 while the player is still in the game", ("room", "player"),
+              players(lambda info: info['active']))
+        gauge("rlgl_player_fps", "Upload frame rate the server asked the player for", ("room", "player"),
+              players(lambda info: info['rate'].stats()['fps']))
+        gauge("rlgl_player_quality", "Upload JPEG quality the server asked the player for", ("room", "player"),
+              players(lambda info: info['rate'].stats()['quality']))
+        gauge("rlgl_player_link_rate", "Upload bytes per second from the player", ("room", "player"),
+              players(lambda info: info['rate'].stats()['link_rate']))
+        def outboxes(field):
+            def read():
+                return [((room_id, label), outbox.stats()[field])
+                        for room_id, room in list(self.gameRooms.items()) for label, outbox in room.outboxes()]
+            return read
+
+        gauge("rlgl_outbox_queued", "Messages waiting for a connection's writer", ("room", "connection"),
+              outboxes('queued'))
+        gauge("rlgl_outbox_bytes", "Plaintext bytes waiting for a connection's writer", ("room", "connection"),
+              outboxes('bytes'))
+        gauge("rlgl_outbox_sent", "Messages a connection's writer has sent", ("room", "connection"), outboxes('sent'))
+        gauge("rlgl_outbox_dropped", "Video frames dropped because the connection fell behind", ("room", "connection"),
+              outboxes('dropped'))
+        gauge("rlgl_handshake_queue", "Accepted connections waiting for a handshake worker", (),
+              lambda: [((), self.handshakes.qsize() + self.handshakes_waiting)])
+        gauge("rlgl_handshake_busy", "Handshake workers in key exchange or login", (),
+              lambda: [((), self.handshakes_busy)])
+        gauge("rlgl_overlay_cache_hits", "Overlay sprite cache hits", (),
+              lambda: [((), Overlay.cache.stats()['hits'])])
+        gauge("rlgl_overlay_cache_misses", "Overlay sprite cache misses", (),
+              lambda: [((), Overlay.cache.stats()['misses'])])
 
 
     def init_db(self):
@@ -200,86 +556,177 @@ class Server:
         except ConnectionError:
             return (None, False)
 
+        username, reply = self.authenticate(msg)
+
+        # Send the JSON reply under AES encryption
+        out = json.dumps(reply).encode()
+        Utils.send_encrypted(sock, aes_key, out)
+        return username, reply["ok"]
+
+    def authenticate(self, msg):
+        """
+        Checks one login/signup request and returns (username, reply). Blocks on the
+        database and the bcrypt pool, so async callers run it in an executor.
+        """
         username = msg["user"]
         password = msg["pass"].encode()
+        try:
+            return username, self.check_credentials(msg["action"], username, password)
+        except Passwords.PasswordsBusy:
+            print(f"[Server] Password queue full, {username} asked to retry")
+            return username, {"ok": False, "error": "Server busy, try again."}
 
+    def check_credentials(self, action, username, password):
         db = sqlite3.connect(self.DB)
         cur = db.cursor()
+        try:
+            if action == "signup":
+                cur.execute("SELECT 1 FROM users WHERE username=?", (username,))
+                if cur.fetchone():
+                    reply = {"ok": False, "error": "Username taken."}
+                else:
+                    pw_hash = self.passwords.hash(password)
+                    cur.execute("INSERT INTO users VALUES (?, ?)", (username, pw_hash))
+                    db.commit()
+                    reply = {"ok": True}
 
-        if msg["action"] == "signup":
-            cur.execute("SELECT 1 FROM users WHERE username=?", (username,))
-            if cur.fetchone():
-                reply = {"ok": False, "error": "Username taken."}
-            else:
-                pw_hash = bcrypt.hashpw(password, bcrypt.gensalt())
-                cur.execute("INSERT INTO users VALUES (?, ?)", (username, pw_hash))
-                db.commit()
-                reply = {"ok": True}
-
-        elif msg["action"] == "login":
-            cur.execute("SELECT pw_hash FROM users WHERE username=?", (username,))
-            row = cur.fetchone()
-            if not row:
-                reply = {"ok": False, "error": "Username not found."}
-            elif bcrypt.checkpw(password, row[0]):
-                reply = {"ok": True}
+            elif action == "login":
+                cur.execute("SELECT pw_hash FROM users WHERE username=?", (username,))
+                row = cur.fetchone()
+                if not row:
+                    reply = {"ok": False, "error": "Username not found."}
+                else:
+                    ok, new_hash = self.passwords.check(password, row[0])
+                    if ok and new_hash is not None:
+                        # Stored with an older cost, keep the rehash done while the password was at hand
+                        cur.execute("UPDATE users SET pw_hash=? WHERE username=?", (new_hash, username))
+                        db.commit()
+                        print(f"[Server] Upgraded {username}'s password hash to cost {self.passwords.rounds}")
+                    reply = {"ok": True} if ok else {"ok": False, "error": "Password invalid."}
             else:
-                reply = {"ok": False, "error": "Password invalid."}
-        else:
-            reply = {"ok": False, "error": "Unknown action."}
-
-        db.close()
-
-        # Send the JSON reply under AES encryption
-        out = json.dumps(reply).encode()
-        Utils.send_encrypted(sock, aes_key, out)
-        return username, reply["ok"]
+                reply = {"ok": False, "error": "Unknown action."}
+        finally:
+            db.close()
+        return reply
+
+    def datagram_loop(self):
+        # Every player's datagram uploads arrive here and go through the same handle_upload as TCP ones
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 2**20)
+        udp.bind((HOST, DATAGRAM_PORT))
+        print(f"[Server] datagrams on {DATAGRAM_PORT}")
+        buffer = bytearray(65536)
+        while True:
+            n = udp.recv_into(buffer)
+            entry = self.channels.get(bytes(buffer[:Datagrams.CHANNEL_SIZE]))
+            if entry is None:
+                continue
+            room, user, receiver = entry
+            plaintext = receiver.feed(memoryview(buffer)[:n])
+            if plaintext is None:
+                continue
+            try:
+                active = room.handle_upload(user, plaintext)
+            except Exception as e:
+                print(f"[datagram_loop] bad upload from {user}:", e)
+                continue
+            if not active or room.winner is not None:
+                room.close_channel(user)
+
+    def player_reply(self, room, user, aes_key, msg):
+        # Reply fields only players get. The first upload credit rides on the reply: anything sent
+        # through the player's outbox could reach the client before it and be read as the reply
+        reply = {"credit": CREDIT_WINDOW}
+        if msg.get("datagrams") and DATAGRAM_PORT is not None:
+            reply.update(self.open_channel(room, user, aes_key))
+        return reply
+
+    def open_channel(self, room, user, aes_key):
+        # Reply fields telling a player where to send datagram uploads, for the receiver registered here
+        channel = Datagrams.new_channel()
+        room.open_channel(user, self.channels, channel, Datagrams.DatagramReceiver(aes_key, channel, server=True))
+        return {"datagram_port": DATAGRAM_PORT, "channel": channel.hex()}
 
     def accept_loop(self):
         srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         srv.bind((HOST, PORT))
         srv.listen()
+        for _ in range(HANDSHAKE_WORKERS):
+            threading.Thread(target=self.handshake_worker, daemon=True).start()
         print(f"Server listening on {PORT}")
         while True:
             sock, addr = srv.accept()
             print(f"[Server] Connection from {addr}")
-
-            # Send server’s RSA public key (DER format), length‐prefixed
-            pub_der = self.server_public.export_key(format='DER')
-            sock.sendall(len(pub_der).to_bytes(4, "big") + pub_der)
-
-            # Receive client’s RSA-encrypted AES key (length‐prefixed)
-            raw = sock.recv(4)
-            if not raw:
+            # Key exchange and login happen on a handshake worker, accept() is never held up
+            try:
+                self.handshakes.put_nowait((sock, addr, time.perf_counter()))
+            except queue.Full:
+                print(f"[Server] Handshake queue full, refusing {addr}")
+                Metrics.handshakes.inc('refused')
                 sock.close()
-                continue
-            ek_len = int.from_bytes(raw, "big")
-            enc_aes_key = Utils.recv_all(sock, ek_len)
-            aes_key = Utils.rsa_decrypt(self.server_private, enc_aes_key)
-
-            # Login dialog
-            login_success = False
-            username = None
-            for i in range(3):
-                username, ok = self.handle_auth(sock, aes_key)
-                if ok:
-                    login_success = True
-                    break
 
-            if not login_success:
+    def handshake_worker(self):
+        while True:
+            sock, addr, accepted = self.handshakes.get()
+            Metrics.handshake_seconds.observe(time.perf_counter() - accepted, 'queued')
+            with self.handshake_lock:
+                self.handshakes_busy += 1
+            try:
+                self.handshake(sock, addr, accepted)
+            except Exception as e:
+                # Timeouts, resets and garbage from the client all end the same way, the worker carries on
+                print(f"[Server] Handshake with {addr} failed:", e)
+                Metrics.handshakes.inc('failed')
                 sock.close()
-                print(f"[Server] Authentication failed for {addr}. Socket closed.")
-                continue
+            finally:
+                with self.handshake_lock:
+                    self.handshakes_busy -= 1
+
+    def handshake(self, sock, addr, accepted):
+        start = time.perf_counter()
+        sock.settimeout(KEY_EXCHANGE_TIMEOUT)
+
+        # Send server’s RSA public key (DER format), length‐prefixed
+        pub_der = self.server_public.export_key(format='DER')
+        sock.sendall(len(pub_der).to_bytes(4, "big") + pub_der)
+
+        # Receive client’s RSA-encrypted AES key (length‐prefixed)
+        ek_len = int.from_bytes(Utils.recv_all(sock, 4), "big")
+        enc_aes_key = Utils.recv_all(sock, ek_len)
+        aes_key = Utils.CryptoSession(Utils.rsa_decrypt(self.server_private, enc_aes_key), server=True)
+        exchanged = time.perf_counter()
+        Metrics.handshake_seconds.observe(exchanged - start, 'key_exchange')
+
+        # Login dialog
+        sock.settimeout(LOGIN_TIMEOUT)
+        login_success = False
+        username = None
+        for i in range(3):
+            username, ok = self.handle_auth(sock, aes_key)
+            if ok:
+                login_success = True
+                break
+        Metrics.handshake_seconds.observe(time.perf_counter() - exchanged, 'login')
 
-            self.sessions[username] = aes_key
-            self.users[username] = sock
-            print(f"[Server] {username} authenticated, AES key established.")
+        if not login_success:
+            sock.close()
+            Metrics.handshakes.inc('rejected')
+            print(f"[Server] Authentication failed for {addr}. Socket closed.")
+            return
 
-            threading.Thread(
-                 target=self.handle_user_request,
-                args=(username, ),
-                daemon=True
-            ).start()
+        sock.settimeout(None)
+        self.sessions[username] = aes_key
+        self.users[username] = sock
+        Metrics.handshakes.inc('ok')
+        print(f"[Server] {username} authenticated, AES key established "
+              f"(key exchange {(exchanged - start) * 1000:.0f} ms, queued {(start - accepted) * 1000:.0f} ms, "
+              f"{self.handshakes.qsize()} waiting).")
+
+        threading.Thread(
+             target=self.handle_user_request,
+            args=(username, ),
+            daemon=True
+        ).start()
 
     def handle_user_request(self, user):
 
@@ -293,81 +740,124 @@ class Server:
             except ConnectionError:
                 print(f"[Server] Connection lost for {user}.")
                 return
+            except ValueError as e:
+                # Bad tag, replayed nonce or not JSON: the connection cannot be trusted any more
+                print(f"[Server] Dropping {user}:", e)
+                sock.close()
+                return
 
-            action = msg.get("action")
-            if action == "create_game":
-                light_duration = msg["light_duration"]
-                if isinstance(light_duration, str) and light_duration == "random":
-                    light_duration = random.randint(1, 30)
-                max_players = msg["max_players"]
-                role = msg["role"]
-
-                gr = GameRoom(light_duration, max_players)
-                self.gameRooms[gr.room_id] = gr
-                success = gr.add_player(user, sock, aes_key, role)
-                reply = {"ok": success, "room_id": gr.room_id}
-                Utils.send_encrypted(sock, aes_key, json.dumps(reply).encode())
-                break
-
-            elif action == "join_game":
-                room_id = msg["room_id"]
-                role    = msg["role"]
-                if room_id not in self.gameRooms:
-                    reply = {"ok": False, "error": "Room not found"}
-                    Utils.send_encrypted(sock, aes_key, json.dumps(reply).encode())
-                else:
-                    gr = self.gameRooms[room_id]
-                    success = gr.add_player(user, sock, aes_key, role)
-                    if success:
-                        reply = {"ok": True, "players": len(gr.users)}
-                    else:
-                        reply = {"ok": False, "error": "Could not join"}
-                    Utils.send_encrypted(sock, aes_key, json.dumps(reply).encode())
-                    break
-
-            elif action == "start_game":
-                room_id = msg["room_id"]
-                if room_id not in self.gameRooms:
-                    reply = {"ok": False, "error": "Room not found"}
-                else:
-                    gr = self.gameRooms[room_id]
-                    # If game_loop not already running, spin it off
-                    threading.Thread(target=gr.game_loop, daemon=True).start()
-                    reply = {"ok": True}
-                Utils.send_encrypted(sock, aes_key, json.dumps(reply).encode())
-                break
-
-            elif action == "get_stats":
-                # pull tallies for this user
-                conn = sqlite3.connect(self.DB)
-                c = conn.cursor()
-                c.execute("SELECT COUNT(*) FROM results WHERE username=?", (user,))
-                games = c.fetchone()[0]
-                c.execute("SELECT COUNT(*) FROM results WHERE username=? AND won=1", (user,))
-                wins = c.fetchone()[0]
-                conn.close()
-                losses = games - wins
-                reply = {
-                    "ok": True,
-                    "games_played": games,
-                    "wins": wins,
-                    "losses": losses
-                }
-                Utils.send_encrypted(sock, aes_key, json.dumps(reply).encode())
-
-            elif action == "exit":
-                reply = {"ok": True}
-                Utils.send_encrypted(sock, aes_key, json.dumps(reply).encode())
+            reply, done = self.dispatch(user, sock, aes_key, msg)
+            Utils.send_encrypted(sock, aes_key, json.dumps(reply).encode())
+            if msg.get("action") == "exit":
                 try: sock.close()
                 except: pass
+            if done:
                 break
 
+    def client_options(self, msg):
+        # What a create/join request says about the client's own streams, checked
+        downstream = msg.get("downstream", "frames")
+        if downstream not in DOWNSTREAMS:
+            downstream = "frames"
+        try:
+            max_fps = min(max(1, int(msg.get("fps", RateControl.MAX_FPS))), MAX_UPLOAD_FPS)
+            max_quality = min(max(1, int(msg.get("quality", RateControl.MAX_QUALITY))), MAX_UPLOAD_QUALITY)
+        except (TypeError, ValueError):
+            max_fps, max_quality = RateControl.MAX_FPS, RateControl.MAX_QUALITY
+        return {'downstream': downstream, 'max_fps': max_fps, 'max_quality': max_quality}
+
+    def room_options(self, msg):
+        # Detection settings a create request asks for, clamped; None if they are not numbers
+        try:
+            detect_interval = int(msg.get("detect_interval", DETECT_INTERVAL))
+            motion_threshold = float(msg.get("motion_threshold", MOTION_THRESHOLD))
+        except (TypeError, ValueError, OverflowError):
+            return None
+        if motion_threshold != motion_threshold:
+            return None   # NaN
+        return {'detect_interval': min(max(1, detect_interval), MAX_DETECT_INTERVAL),
+                'motion_threshold': min(max(0.0, motion_threshold), 1.0)}
+
+    def dispatch(self, user, sock, aes_key, msg, start_reader=True):
+        """
+        Runs one lobby request and returns (reply, done). done means the connection stops
+        sending lobby requests: it joined a room, started one, left or was not understood.
+        """
+        action = msg.get("action")
+        if action == "create_game":
+            light_duration = msg["light_duration"]
+            if isinstance(light_duration, str) and light_duration == "random":
+                light_duration = random.randint(1, 30)
+            max_players = msg["max_players"]
+            role = msg["role"]
+            options = self.room_options(msg)
+            if options is None:
+                return {"ok": False, "error": "Invalid detection settings"}, False
+            tracker = msg.get("tracker", TRACKER)
+            if tracker not in TRACKERS:
+                tracker = TRACKER
+
+            gr = GameRoom(light_duration, max_players, self.scheduler, tracker=tracker, **options)
+            self.gameRooms[gr.room_id] = gr
+            success = gr.add_player(user, sock, aes_key, role, start_reader, **self.client_options(msg))
+            reply = {"ok": success, "room_id": gr.room_id}
+            if success and role == "player":
+                reply.update(self.player_reply(gr, user, aes_key, msg))
+            return reply, True
+
+        elif action == "join_game":
+            room_id = msg["room_id"]
+            role    = msg["role"]
+            if room_id not in self.gameRooms:
+                return {"ok": False, "error": "Room not found"}, False
+            gr = self.gameRooms[room_id]
+            success = gr.add_player(user, sock, aes_key, role, start_reader, **self.client_options(msg))
+            if success:
+                reply = {"ok": True, "players": len(gr.users)}
+                if role == "player":
+                    reply.update(self.player_reply(gr, user, aes_key, msg))
             else:
-                reply = {"ok": False, "error": "Unknown action"}
-                Utils.send_encrypted(sock, aes_key, json.dumps(reply).encode())
-                break
+                reply = {"ok": False, "error": "Could not join"}
+            return reply, True
+
+        elif action == "start_game":
+            room_id = msg["room_id"]
+            if room_id not in self.gameRooms:
+                reply = {"ok": False, "error": "Room not found"}
+            else:
+                gr = self.gameRooms[room_id]
+                # If game_loop not already running, spin it off
+                threading.Thread(target=gr.game_loop, daemon=True).start()
+                reply = {"ok": True}
+            return reply, True
+
+        elif action == "get_stats":
+            # pull tallies for this user
+            conn = sqlite3.connect(self.DB)
+            c = conn.cursor()
+            c.execute("SELECT COUNT(*) FROM results WHERE username=?", (user,))
+            games = c.fetchone()[0]
+            c.execute("SELECT COUNT(*) FROM results WHERE username=? AND won=1", (user,))
+            wins = c.fetchone()[0]
+            conn.close()
+            losses = games - wins
+            reply = {
+                "ok": True,
+                "games_played": games,
+                "wins": wins,
+                "losses": losses
+            }
+            return reply, False
+
+        elif action == "exit":
+            return {"ok": True}, True
+
+        return {"ok": False, "error": "Unknown action"}, True
 
 def main():
+    if ASYNC_CORE:
+        import AsyncServer
+        return AsyncServer.main()
     server = Server()
     server.accept_loop()
 
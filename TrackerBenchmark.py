@@ -0,0 +1,121 @@
+import os
+import sys
+import json
+import time
+import argparse
+import cv2
+import numpy as np
+import Detector
+import Replay
+import Utils
+from GameLogic import make_tracker, TRACKERS
+from Tracking import iou_matrix, greedy_match
+
+
+def load_frames(source, limit=None):
+    # A recorded session: a Replay.py recording (first player), a video file or a folder of frames
+    frames = []
+    if source.endswith(".rlgl"):
+        player = None
+        for kind, _, user, body in Replay.read_session(source):
+            if kind != 'frame' or (player is not None and user != player):
+                continue
+            player = user
+            frames.append(Utils.decode_frame(body[3]))
+            if limit and len(frames) >= limit:
+                break
+    elif os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.lower().endswith((".jpg", ".jpeg", ".png")):
+                frames.append(cv2.imread(os.path.join(source, name)))
+                if limit and len(frames) >= limit:
+                    break
+    else:
+        cap = cv2.VideoCapture(source)
+        while cap.isOpened() and not (limit and len(frames) >= limit):
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+        cap.release()
+    return frames
+
+
+def detect_all(frames, weights, backend):
+    # The detector runs once per frame up front so every tracker sees identical input
+    detector = Detector.registry.acquire(weights, backend)
+    letterbox = Detector.Letterbox()
+    images, detections = [], []
+    for frame in frames:
+        image = letterbox.fit(frame).copy()
+        boxes = detector([image])[0]
+        images.append(image)
+        detections.append([[[int(x1), int(y1), int(x2 - x1), int(y2 - y1)], float(conf), None]
+                           for x1, y1, x2, y2, conf in boxes])
+    Detector.registry.release(detector)
+    return images, detections
+
+
+def id_switches(history, iou_threshold=0.5):
+    """
+    Without ground truth, a switch is a confirmed box that overlaps a box from the
+    previous frame by at least iou_threshold but carries a different id.
+    Returns (switches, continued boxes).
+    """
+    switches = matched = 0
+    for prev, cur in zip(history, history[1:]):
+        if not prev or not cur:
+            continue
+        prev_boxes = np.array([box for _, box in prev], np.float32)
+        cur_boxes = np.array([box for _, box in cur], np.float32)
+        for r, c in greedy_match(iou_matrix(prev_boxes, cur_boxes), iou_threshold):
+            matched += 1
+            if prev[r][0] != cur[c][0]:
+                switches += 1
+    return switches, matched
+
+
+def run_tracker(name, images, detections):
+    tracker = make_tracker(name)
+    times, history, ids = [], [], set()
+    for image, dets in zip(images, detections):
+        start = time.perf_counter()
+        tracks = tracker.update_tracks(dets, frame=image)
+        times.append(time.perf_counter() - start)
+        confirmed = [(track.track_id, track.to_tlwh()) for track in tracks if track.is_confirmed()]
+        ids.update(track_id for track_id, _ in confirmed)
+        history.append(confirmed)
+    switches, matched = id_switches(history)
+    times_ms = np.array(times) * 1000
+    return {'tracker': name, 'frames': len(times), 'mean_ms': float(times_ms.mean()),
+            'p95_ms': float(np.percentile(times_ms, 95)), 'ids': len(ids), 'id_switches': switches,
+            'id_switch_rate': switches / matched if matched else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare tracker cost and ID stability on a recorded session")
+    parser.add_argument("source", help="session recording (.rlgl), video file or folder of frames")
+    parser.add_argument("--trackers", nargs="+", default=list(TRACKERS), choices=TRACKERS)
+    parser.add_argument("--weights", default=Detector.DEFAULT_WEIGHTS)
+    parser.add_argument("--backend", default=Detector.DEFAULT_BACKEND, choices=sorted(Detector.BACKENDS))
+    parser.add_argument("--limit", type=int, help="only use the first N frames")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    frames = load_frames(args.source, args.limit)
+    if not frames:
+        print(f"No frames found in {args.source}")
+        return 1
+    images, detections = detect_all(frames, args.weights, args.backend)
+    results = [run_tracker(name, images, detections) for name in args.trackers]
+    for row in results:
+        print(f"{row['tracker']:<10} {row['mean_ms']:8.2f} ms/frame (p95 {row['p95_ms']:.2f}) "
+              f"{row['ids']:4d} ids {row['id_switches']:4d} switches ({row['id_switch_rate']:.2%})")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+import cv2
+import numpy as np
+
+
+class FlowInterpolator:
+    """
+    Carries the tracked player boxes forward between detector runs.
+    Corner points inside every box are followed with pyramidal Lucas-Kanade optical flow
+    and each box is shifted by the median motion of its points, so a player who moves
+    during red light still moves their box.
+    """
+
+    def __init__(self, scale=0.5, max_corners=25, min_tracked=0.5):
+        self.scale = scale                  # flow runs on a downscaled grey image
+        self.max_corners = max_corners
+        self.min_tracked = min_tracked      # fraction of a box's points that must survive
+        self.prev_gray = None
+        self.boxes = []                     # [(track_id, x1, y1, w, h)]
+        self.points = []                    # per box: (K, 1, 2) float32 points in scaled coordinates
+        self.lost = True
+
+    def gray(self, frame):
+        small = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    def seed(self, gray, box):
+        _, x1, y1, w, h = box
+        mask = np.zeros_like(gray)
+        x1, y1 = max(int(x1 * self.scale), 0), max(int(y1 * self.scale), 0)
+        x2, y2 = int((box[1] + w) * self.scale), int((box[2] + h) * self.scale)
+        mask[y1:y2, x1:x2] = 255
+        points = cv2.goodFeaturesToTrack(gray, self.max_corners, 0.01, 3, mask=mask)
+        return points if points is not None else np.empty((0, 1, 2), np.float32)
+
+    def reset(self, frame, boxes):
+        # Called with fresh tracker output after every detector run
+        self.prev_gray = self.gray(frame)
+        self.boxes = list(boxes)
+        self.points = [self.seed(self.prev_gray, box) for box in self.boxes]
+        self.lost = any(len(points) == 0 for points in self.points)
+
+    def update(self, frame):
+        gray = self.gray(frame)
+        if self.prev_gray is None or not self.boxes:
+            self.prev_gray = gray
+            return self.current()
+
+        counts = [len(points) for points in self.points]
+        all_points = np.concatenate(self.points) if sum(counts) else np.empty((0, 1, 2), np.float32)
+        if len(all_points):
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, all_points, None,
+                                                        winSize=(15, 15), maxLevel=2)
+            status = status.reshape(-1).astype(bool)
+        else:
+            moved, status = all_points, np.zeros(0, bool)
+
+        boxes, points, start = [], [], 0
+        self.lost = False
+        for box, old_points, count in zip(self.boxes, self.points, counts):
+            ok = status[start:start + count]
+            if count == 0 or ok.sum() < self.min_tracked * count:
+                # Not enough texture followed this player, ask for a detection
+                self.lost = True
+                boxes.append(box)
+                points.append(old_points)
+            else:
+                delta = np.median(moved[start:start + count][ok] - all_points[start:start + count][ok], axis=0)
+                dx, dy = delta.reshape(2) / self.scale
+                track_id, x1, y1, w, h = box
+                boxes.append((track_id, x1 + dx, y1 + dy, w, h))
+                points.append(moved[start:start + count][ok].reshape(-1, 1, 2))
+            start += count
+
+        self.prev_gray = gray
+        self.boxes = boxes
+        self.points = points
+        return self.current()
+
+    def current(self):
+        # Boxes are kept in float so slow drifts add up instead of rounding away
+        return [(track_id, int(round(x1)), int(round(y1)), w, h) for track_id, x1, y1, w, h in self.boxes]
+
+
+class MotionGate:
+    """
+    Cheap change detector in front of the detector.
+    Frames are shrunk to a small grey thumbnail and compared with the thumbnail of the
+    last frame that was fully processed; if fewer than `threshold` of the pixels changed
+    by more than `pixel_threshold` grey levels, nothing in view has moved.
+    """
+
+    def __init__(self, threshold=0.002, pixel_threshold=25, size=(160, 120)):
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.size = size
+        self.reference = None
+        self.small = None
+
+    def is_static(self, frame):
+        small = cv2.cvtColor(cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        self.small = small
+        if self.reference is None:
+            return False
+        diff = cv2.absdiff(small, self.reference)
+        _, changed = cv2.threshold(diff, self.pixel_threshold, 255, cv2.THRESH_BINARY)
+        return cv2.countNonZero(changed) < self.threshold * changed.size
+
+    def accept(self):
+        # The last checked frame was fully processed, later frames are compared with it
+        self.reference = self.small
+
+
+def iou_matrix(a, b):
+    # Pairwise IoU between two (N, 4) and (M, 4) arrays of x1, y1, w, h boxes
+    if not len(a) or not len(b):
+        return np.zeros((len(a), len(b)), np.float32)
+    a1, a2 = a[:, None, :2], a[:, None, :2] + a[:, None, 2:]
+    b1, b2 = b[None, :, :2], b[None, :, :2] + b[None, :, 2:]
+    size = np.clip(np.minimum(a2, b2) - np.maximum(a1, b1), 0, None)
+    inter = size[..., 0] * size[..., 1]
+    union = (a[:, None, 2] * a[:, None, 3]) + (b[None, :, 2] * b[None, :, 3]) - inter
+    return inter / np.maximum(union, 1e-6)
+
+
+def greedy_match(iou, threshold):
+    # Pairs (row, col) by descending IoU, each row and column used once
+    pairs = []
+    if iou.size:
+        rows, cols = np.unravel_index(np.argsort(-iou, axis=None), iou.shape)
+        used_rows, used_cols = set(), set()
+        for r, c in zip(rows, cols):
+            if iou[r, c] < threshold:
+                break
+            if r in used_rows or c in used_cols:
+                continue
+            used_rows.add(r)
+            used_cols.add(c)
+            pairs.append((r, c))
+    return pairs
+
+
+class IouTrack:
+    # Same surface as a DeepSort track, as far as Game uses it
+
+    def __init__(self, track_id, tlwh, conf, n_init):
+        self.track_id = track_id
+        self.tlwh = np.asarray(tlwh, np.float32)
+        self.measured = self.tlwh.copy()    # last detected box, predictions never feed the velocity
+        self.velocity = np.zeros(2, np.float32)
+        self.det_conf = conf
+        self.hits = 1
+        self.n_init = n_init
+        self.time_since_update = 0
+        self.confirmed = n_init <= 1
+
+    def is_confirmed(self):
+        return self.confirmed
+
+    def to_tlwh(self):
+        return self.tlwh.copy()
+
+    def predict(self):
+        self.tlwh[:2] += self.velocity
+        self.velocity *= 0.5    # players mostly stand still, let coasting die out quickly
+        self.time_since_update += 1
+
+    def update(self, tlwh, conf):
+        tlwh = np.asarray(tlwh, np.float32)
+        # Per frame, over however many frames the track coasted since it was last seen
+        self.velocity = (tlwh[:2] - self.measured[:2]) / max(self.time_since_update, 1)
+        self.tlwh = tlwh
+        self.measured = tlwh.copy()
+        self.det_conf = conf
+        self.hits += 1
+        self.time_since_update = 0
+        if self.hits >= self.n_init:
+            self.confirmed = True
+
+
+class IouTracker:
+    """
+    Motion-only tracker with the DeepSort update_tracks() interface.
+    Detections are associated by box overlap in two passes, ByteTrack style: confident
+    detections against every track first, then the weaker ones against the confirmed
+    tracks left over, so a player who is briefly detected with low confidence keeps
+    their id. No appearance embedding is computed.
+    """
+
+    def __init__(self, max_age=100, n_init=3, high_conf=0.6, match_iou=0.3, low_match_iou=0.5):
+        self.max_age = max_age
+        self.n_init = n_init
+        self.high_conf = high_conf
+        self.match_iou = match_iou
+        self.low_match_iou = low_match_iou
+        self.tracks = []
+        self.next_id = 1
+
+    def update_tracks(self, raw_detections, frame=None):
+        for track in self.tracks:
+            track.predict()
+
+        boxes = np.array([det[0] for det in raw_detections], np.float32).reshape(-1, 4)
+        confs = np.array([det[1] for det in raw_detections], np.float32)
+        high = np.flatnonzero(confs >= self.high_conf)
+        low = np.flatnonzero(confs < self.high_conf)
+
+        # 1) Confident detections against every track
+        track_boxes = np.array([track.tlwh for track in self.tracks], np.float32).reshape(-1, 4)
+        unmatched_tracks = set(range(len(self.tracks)))
+        unmatched_high = set(high.tolist())
+        for r, c in greedy_match(iou_matrix(track_boxes, boxes[high]), self.match_iou):
+            self.tracks[r].update(boxes[high[c]], confs[high[c]])
+            unmatched_tracks.discard(r)
+            unmatched_high.discard(int(high[c]))
+
+        # 2) Weak detections only rescue confirmed tracks that are still unmatched
+        leftovers = [t for t in sorted(unmatched_tracks) if self.tracks[t].confirmed]
+        for r, c in greedy_match(iou_matrix(track_boxes[leftovers], boxes[low]), self.low_match_iou):
+            self.tracks[leftovers[r]].update(boxes[low[c]], confs[low[c]])
+            unmatched_tracks.discard(leftovers[r])
+
+        # 3) New tracks from unmatched confident detections, drop stale ones
+        for d in sorted(unmatched_high):
+            self.tracks.append(IouTrack(str(self.next_id), boxes[d], confs[d], self.n_init))
+            self.next_id += 1
+        self.tracks = [track for track in self.tracks
+                       if (track.confirmed and track.time_since_update <= self.max_age)
+                       or (not track.confirmed and track.time_since_update == 0)]
+        return self.tracks
@@ -0,0 +1,260 @@
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import socket
+import argparse
+import platform
+import threading
+import Utils
+import Datagrams
+
+KEY = bytes(range(16))
+MSS = 1200              # bytes per simulated TCP segment, about one datagram
+
+
+class Scheduler:
+    """
+    Runs callbacks at given perf_counter times on one thread, in time order; the
+    simulated link delivers through it.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.count = 0
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def at(self, when, fn, *args):
+        with self.cond:
+            self.count += 1
+            heapq.heappush(self.items, (when, self.count, fn, args))
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.items:
+                        wait = self.items[0][0] - time.perf_counter()
+                        if wait <= 0:
+                            break
+                        self.cond.wait(wait)
+                    elif self.closed:
+                        return
+                    else:
+                        self.cond.wait()
+                _, _, fn, args = heapq.heappop(self.items)
+            try:
+                fn(*args)
+            except OSError:
+                pass
+
+    def close(self):
+        # Whatever is scheduled still runs
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+
+class Link:
+    """
+    One direction of a lossy path: each packet takes delay plus up to jitter seconds
+    and is lost with probability loss. Over UDP jitter reorders datagrams and a lost
+    one is gone. Over TCP a lost segment arrives one retransmission timeout later and,
+    since TCP delivers in order, holds back every segment behind it.
+    """
+
+    def __init__(self, delay, jitter, loss, rto, seed):
+        self.delay, self.jitter, self.loss, self.rto = delay, jitter, loss, rto
+        self.random = random.Random(seed)
+        self.scheduler = Scheduler()
+        self.last = 0.0   # TCP: when the previous segment was delivered
+        self.lost = 0
+
+    def datagram(self, sock, addr, data):
+        if self.random.random() < self.loss:
+            self.lost += 1
+            return
+        when = time.perf_counter() + self.delay + self.random.uniform(0, self.jitter)
+        self.scheduler.at(when, sock.sendto, data, addr)
+
+    def segment(self, sock, data):
+        when = time.perf_counter() + self.delay + self.random.uniform(0, self.jitter)
+        if self.random.random() < self.loss:
+            self.lost += 1
+            when += self.rto
+        self.last = when = max(when, self.last)
+        self.scheduler.at(when, sock.sendall, data)
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {'p50_ms': pick(0.50), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99), 'max_ms': ordered[-1] * 1000}
+
+
+def send_frames(send, size, fps, frames):
+    # send(plaintext) for each frame, paced at fps; the capture time field carries perf_counter
+    payload = os.urandom(size)
+    deadline = time.perf_counter()
+    for seq in range(1, frames + 1):
+        send(Utils.UPLOAD_HEADER.pack(False, seq, time.perf_counter()) + payload)
+        deadline += 1 / fps
+        time.sleep(max(0.0, deadline - time.perf_counter()))
+
+
+def result(latencies, frames, lost, elapsed):
+    row = {'frames': frames, 'delivered': len(latencies), 'delivered_fraction': len(latencies) / frames,
+           'packets_lost': lost, 'seconds': elapsed}
+    row.update(percentiles(latencies))
+    return row
+
+
+def bench_tcp(size, fps, frames, delay, jitter, loss, rto, seed):
+    link = Link(delay, jitter, loss, rto, seed)
+    listener = socket.create_server(("127.0.0.1", 0))
+    sender = socket.create_connection(listener.getsockname())
+    relay_in, _ = listener.accept()
+    relay_out, receiver = socket.socketpair()
+    listener.close()
+
+    def relay():
+        # Cuts the byte stream into segments and puts each on the link
+        while True:
+            data = relay_in.recv(65536)
+            if not data:
+                break
+            for i in range(0, len(data), MSS):
+                link.segment(relay_out, data[i:i + MSS])
+
+    latencies = []
+
+    def receive():
+        reader = Utils.FrameReader(receiver, Utils.CryptoSession(KEY, server=True))
+        for _ in range(frames):
+            plaintext = reader.read()
+            _, _, sent = Utils.UPLOAD_HEADER.unpack_from(plaintext)
+            latencies.append(time.perf_counter() - sent)
+
+    threads = [threading.Thread(target=relay, daemon=True), threading.Thread(target=receive, daemon=True)]
+    for thread in threads:
+        thread.start()
+    writer = Utils.FrameWriter(sender, Utils.CryptoSession(KEY, server=False))
+    start = time.perf_counter()
+    send_frames(writer.write, size, fps, frames)
+    sender.shutdown(socket.SHUT_WR)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    link.scheduler.close()
+    for sock in (sender, relay_in, relay_out, receiver):
+        sock.close()
+    return result(latencies, frames, link.lost, elapsed)
+
+
+def bench_udp(size, fps, frames, delay, jitter, loss, rto, seed):
+    link = Link(delay, jitter, loss, rto, seed)
+    relay_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for sock in (relay_sock, receiver):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 2**20)
+        sock.bind(("127.0.0.1", 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.connect(relay_sock.getsockname())
+    channel = Datagrams.new_channel()
+    done = threading.Event()
+
+    def relay():
+        relay_sock.settimeout(0.1)
+        while not done.is_set():
+            try:
+                data = relay_sock.recv(65536)
+            except socket.timeout:
+                continue
+            link.datagram(relay_sock, receiver.getsockname(), data)
+
+    latencies = []
+    session = Utils.CryptoSession(KEY, server=True)
+    reassembly = Datagrams.DatagramReceiver(session, channel, server=True)
+
+    def receive():
+        receiver.settimeout(0.1)
+        while not done.is_set():
+            try:
+                data = receiver.recv(65536)
+            except socket.timeout:
+                continue
+            plaintext = reassembly.feed(data)
+            if plaintext is not None:
+                _, _, sent = Utils.UPLOAD_HEADER.unpack_from(plaintext)
+                latencies.append(time.perf_counter() - sent)
+
+    threads = [threading.Thread(target=relay, daemon=True), threading.Thread(target=receive, daemon=True)]
+    for thread in threads:
+        thread.start()
+    uplink = Datagrams.DatagramSender(sender, Utils.CryptoSession(KEY, server=False), channel)
+    start = time.perf_counter()
+    send_frames(uplink.send, size, fps, frames)
+    # Nothing is retransmitted: once the link has drained, whatever did not arrive never will
+    time.sleep(delay + jitter + 0.2)
+    link.scheduler.close()
+    time.sleep(0.2)
+    done.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    for sock in (sender, relay_sock, receiver):
+        sock.close()
+    row = result(latencies, frames, link.lost, elapsed)
+    row['reassembly'] = reassembly.stats()
+    return row
+
+
+def run(size_kb=30, fps=15, frames=300, delay=0.02, jitter=0.005, losses=(0.0, 0.01, 0.05), rto=0.2, seed=1):
+    results = {'python': platform.python_version(), 'machine': platform.machine(), 'size_kb': size_kb, 'fps': fps,
+               'frames': frames, 'delay': delay, 'jitter': jitter, 'rto': rto, 'runs': []}
+    for loss in losses:
+        args = (size_kb * 1024, fps, frames, delay, jitter, loss, rto, seed)
+        results['runs'].append({'loss': loss, 'tcp': bench_tcp(*args), 'udp': bench_udp(*args)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame latency over a simulated lossy link: TCP stream vs datagrams")
+    parser.add_argument("--size", type=int, default=30, help="frame size in KB")
+    parser.add_argument("--fps", type=float, default=15)
+    parser.add_argument("--frames", type=int, default=300, help="frames per run")
+    parser.add_argument("--delay", type=float, default=0.02, help="one-way delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.005, help="extra random delay in seconds, reorders datagrams")
+    parser.add_argument("--loss", type=float, nargs="+", default=[0.0, 0.01, 0.05], help="packet loss probabilities")
+    parser.add_argument("--rto", type=float, default=0.2, help="TCP retransmission timeout in seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    results = run(args.size, args.fps, args.frames, args.delay, args.jitter, args.loss, args.rto, args.seed)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+        for row in results['runs']:
+            for transport in ('tcp', 'udp'):
+                r = row[transport]
+                print(f"loss {row['loss']:5.1%}  {transport}  delivered {r['delivered_fraction']:6.1%}  "
+                      f"p50 {r.get('p50_ms', 0):7.1f} ms  p99 {r.get('p99_ms', 0):7.1f} ms  "
+                      f"max {r.get('max_ms', 0):7.1f} ms")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
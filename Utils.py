@@ -1,10 +1,18 @@
 import numpy as np
+import time
+import logging
+import weakref
 import threading
+import collections
+import struct
+import cv2
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP, AES
 from Crypto.Random import get_random_bytes
 from Crypto.Util.Padding import pad, unpad
 
+log = logging.getLogger(__name__)
+
 def generate_rsa_keypair(bits=2048):
     key = RSA.generate(bits)
     private_rsa = key
@@ -32,16 +40,82 @@ AES_NONCE_SIZE = 12   # recommended for GCM
 AES_TAG_SIZE = 16     # GCM authentication tag = 16 bytes
 
 
-def aes_encrypt(aes_key: bytes, plaintext: bytes) -> bytes:
+class CryptoSession:
+    """
+    AES-GCM state for one connection, usable wherever a raw AES key is accepted.
+    Nonces are a 4-byte direction prefix and an 8-byte message counter, so they never
+    repeat under the key without drawing random bytes, and the two directions never
+    collide. On receive the counter must increase: a replayed or reordered message is
+    rejected even though its tag is valid.
+    """
+    SERVER = b"\x00\x00\x00\x01"
+    CLIENT = b"\x00\x00\x00\x02"
+
+    def __init__(self, aes_key, server):
+        self.key = bytes(aes_key)
+        self.send_prefix, self.recv_prefix = (self.SERVER, self.CLIENT) if server else (self.CLIENT, self.SERVER)
+        self.send_counter = 0
+        self.recv_counter = 0
+        self.lock = threading.Lock()
+
+    def next_nonce(self):
+        with self.lock:
+            self.send_counter += 1
+            return self.send_prefix + self.send_counter.to_bytes(8, "big")
+
+    def check_nonce(self, nonce):
+        # Before decrypting: cheap rejection of anything not newer than the last message
+        counter = int.from_bytes(nonce[4:], "big")
+        if bytes(nonce[:4]) != self.recv_prefix or counter <= self.recv_counter:
+            raise ValueError("Replayed or out-of-order message")
+        return counter
+
+    def accept(self, counter):
+        # After the tag verified
+        self.recv_counter = counter
+
+
+def seal(key, plaintext, output=None):
+    """
+    Encrypts for one message under a CryptoSession or a raw AES key (random nonce).
+    Returns (nonce, ciphertext, tag); with output the ciphertext is written there.
+    """
+    if isinstance(key, CryptoSession):
+        nonce, key = key.next_nonce(), key.key
+    else:
+        nonce = get_random_bytes(AES_NONCE_SIZE)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    if output is None:
+        ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+        return nonce, ciphertext, tag
+    _, tag = cipher.encrypt_and_digest(plaintext, output=output)
+    return nonce, output, tag
+
+
+def unseal(key, nonce, ciphertext, tag, output=None):
+    """
+    Decrypts and verifies one message; raises ValueError on a bad tag or, for a
+    CryptoSession, a replayed nonce. With output the plaintext is written there.
+    """
+    session = key if isinstance(key, CryptoSession) else None
+    if session is not None:
+        counter = session.check_nonce(nonce)
+        key = session.key
+    cipher = AES.new(key, AES.MODE_GCM, nonce=bytes(nonce))
+    plaintext = cipher.decrypt_and_verify(ciphertext, tag, output=output)
+    if session is not None:
+        session.accept(counter)
+    return plaintext
+
+
+def aes_encrypt(aes_key, plaintext: bytes) -> bytes:
     """
     Returns a bytes object: 12‐byte nonce || ciphertext || 16‐byte tag.
     """
-    nonce = get_random_bytes(AES_NONCE_SIZE)
-    cipher = AES.new(aes_key, AES.MODE_GCM, nonce=nonce)
-    ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+    nonce, ciphertext, tag = seal(aes_key, plaintext)
     return nonce + ciphertext + tag
 
-def aes_decrypt(aes_key: bytes, data: bytes) -> bytes:
+def aes_decrypt(aes_key, data: bytes) -> bytes:
     """
     Expects data = nonce (12 bytes) || ciphertext || tag (16 bytes).
     Returns the decrypted plaintext or raises ValueError if tag fails.
@@ -49,78 +123,332 @@ def aes_decrypt(aes_key: bytes, data: bytes) -> bytes:
     nonce = data[:AES_NONCE_SIZE]
     tag = data[-AES_TAG_SIZE:]
     ciphertext = data[AES_NONCE_SIZE:-AES_TAG_SIZE]
-    cipher = AES.new(aes_key, AES.MODE_GCM, nonce=nonce)
-    return cipher.decrypt_and_verify(ciphertext, tag)
+    return unseal(aes_key, nonce, ciphertext, tag)
 
 #
 # 4) “send_encrypted” / “recv_encrypted” wrappers over a socket
 #    We prefix each encrypted blob with a 4‐byte big‐endian length.
 #
-send_lock = threading.Lock()
-def send_encrypted(sock, aes_key, plaintext):
-    blob = aes_encrypt(aes_key, plaintext)
-    msg = len(blob).to_bytes(4, "big") + blob
-    with send_lock:
-        sock.sendall(msg)
+# Player uploads: win flag, frame sequence number, capture time (seconds since epoch), then the JPEG
+UPLOAD_HEADER = struct.Struct(">?Id")
+# Server to client: game active, player alive, red light, then what follows the header
+DOWNSTREAM_HEADER = struct.Struct(">???B")
+DOWNSTREAM_FRAME = 0         # an annotated JPEG
+DOWNSTREAM_ANNOTATIONS = 1   # a JSON Game.annotations() message, drawn by the client on its own frame
+DOWNSTREAM_CONTROL = 2       # a JSON message for the capture side: {"credit": 1}, {"fps": 10, "quality": 25}
+
+# One lock per socket: messages on a socket never interleave, sends on different sockets never wait on each other
+send_locks = weakref.WeakKeyDictionary()
+send_locks_guard = threading.Lock()
+
+
+def socket_lock(sock):
+    with send_locks_guard:
+        lock = send_locks.get(sock)
+        if lock is None:
+            lock = send_locks[sock] = threading.Lock()
+        return lock
+
 
-def recv_encrypted(sock, aes_key: bytes) -> bytes:
+def send_parts(sock, parts):
     """
-    Receives 4-byte length, then that many bytes; decrypts with aes_key and returns plaintext.
-    Includes detailed debug output to help diagnose encryption errors.
+    Sends the buffers back to back as one message; the caller holds socket_lock(sock).
+    Where the socket has sendmsg they go out scatter-gather, straight from where they
+    are, otherwise they are joined first.
     """
-    try:
-        # Receive the 4-byte length prefix
-        length_buffer = recv_all(sock, 4)
-        if not length_buffer:
-            raise ConnectionError("Socket closed when expecting length prefix")
-
-        length = int.from_bytes(length_buffer, "big")
-        print(f"[recv_encrypted] Expecting {length} bytes of encrypted data")
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(parts))
+        return
+    views = [memoryview(part).cast("B") for part in parts]
+    while views:
+        sent = sock.sendmsg(views)
+        # A partial send can end inside any of the buffers
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent:
+            views[0] = views[0][sent:]
 
-        # Receive the full encrypted blob
-        data = recv_all(sock, length)
-        actual_length = len(data)
-        print(f"[recv_encrypted] Received {actual_length} bytes")
 
-        if actual_length != length:
-            raise ValueError(f"Expected {length} bytes, but received {actual_length}")
+def send_encrypted(sock, aes_key, plaintext):
+    # aes_key may be a CryptoSession: its nonces are taken under the socket lock so they reach the peer in order
+    with socket_lock(sock):
+        nonce, ciphertext, tag = seal(aes_key, plaintext)
+        length = AES_NONCE_SIZE + len(ciphertext) + AES_TAG_SIZE
+        send_parts(sock, [length.to_bytes(4, "big"), nonce, ciphertext, tag])
 
-        nonce = data[:AES_NONCE_SIZE]
-        tag = data[-AES_TAG_SIZE:]
-        ciphertext = data[AES_NONCE_SIZE:-AES_TAG_SIZE]
+def recv_encrypted(sock, aes_key) -> bytearray:
+    """
+    Receives 4-byte length, then that many bytes; decrypts with aes_key (or a
+    CryptoSession) and returns plaintext. The ciphertext is received into its own buffer
+    and decrypted in place. Debug output goes to the "Utils" logger at DEBUG level and
+    is not even formatted otherwise.
+    """
+    try:
+        # Receive the 4-byte length prefix and the nonce
+        head = recv_all(sock, 4 + AES_NONCE_SIZE)
+        length = int.from_bytes(head[:4], "big")
+        if length < AES_NONCE_SIZE + AES_TAG_SIZE:
+            raise ValueError(f"Message of {length} bytes is too short")
 
-        print(f"[recv_encrypted] Nonce: {nonce.hex()}")
-        print(f"[recv_encrypted] Tag:   {tag.hex()}")
-        print(f"[recv_encrypted] Ciphertext length: {len(ciphertext)}")
+        # Receive the ciphertext and the tag
+        nonce = bytes(head[4:])
+        ciphertext = recv_all(sock, length - AES_NONCE_SIZE - AES_TAG_SIZE)
+        tag = bytes(recv_all(sock, AES_TAG_SIZE))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("[recv_encrypted] Received %d bytes, nonce %s, tag %s, ciphertext %d bytes",
+                      length, nonce.hex(), tag.hex(), len(ciphertext))
 
         # Decrypt and verify
-        cipher = AES.new(aes_key, AES.MODE_GCM, nonce=nonce)
-        plaintext = cipher.decrypt_and_verify(ciphertext, tag)
-        print(f"[recv_encrypted] Decryption successful, plaintext length: {len(plaintext)}")
-
-        return plaintext
+        unseal(aes_key, nonce, ciphertext, tag, output=ciphertext)
+        return ciphertext
 
     except ValueError as ve:
-        print(f"[recv_encrypted] Decryption failed: {ve}")
+        log.warning("[recv_encrypted] Decryption failed: %s", ve)
         raise
 
     except Exception as e:
-        print(f"[recv_encrypted] Unexpected error: {e}")
+        log.debug("[recv_encrypted] Unexpected error: %s", e)
         raise
 
 
+def recv_into_all(sock, view):
+    # Fills the whole view, however many reads it takes
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionError("Socket closed")
+        view = view[received:]
 
 
 def recv_all(sock, n):
-    data = b""
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
-            raise ConnectionError("Socket closed")
-        data += packet
+    data = bytearray(n)
+    recv_into_all(sock, memoryview(data))
     return data
 
 
+class FrameReader:
+    """
+    recv_encrypted for a socket that carries a stream of frames. Messages are received
+    into buffers kept between calls and decrypted in place, so a frame costs no
+    allocation or copy. The memoryview read() returns is only valid until the next
+    read(); copy it to keep it.
+    """
+
+    def __init__(self, sock, aes_key, size=256 * 1024):
+        self.sock = sock
+        self.aes_key = aes_key
+        self.head = bytearray(4 + AES_NONCE_SIZE)
+        self.tag = bytearray(AES_TAG_SIZE)
+        self.buffer = bytearray(size)
+
+    def read(self):
+        recv_into_all(self.sock, memoryview(self.head))
+        length = int.from_bytes(self.head[:4], "big") - AES_NONCE_SIZE - AES_TAG_SIZE
+        if length < 0:
+            raise ValueError("Message too short")
+        if length > len(self.buffer):
+            # A new buffer rather than a resize, the caller may still hold a view of the old one
+            self.buffer = bytearray(max(length, 2 * len(self.buffer)))
+        body = memoryview(self.buffer)[:length]
+        recv_into_all(self.sock, body)
+        recv_into_all(self.sock, memoryview(self.tag))
+        unseal(self.aes_key, self.head[4:], body, self.tag, output=body)
+        return body
+
+
+class FrameWriter:
+    """
+    send_encrypted for a socket that carries a stream of frames: the ciphertext goes
+    into a buffer kept between calls and out with the length, nonce and tag in one
+    scatter-gather send.
+    """
+
+    def __init__(self, sock, aes_key, size=256 * 1024):
+        self.sock = sock
+        self.aes_key = aes_key
+        self.buffer = bytearray(size)
+
+    def write(self, plaintext):
+        if len(plaintext) > len(self.buffer):
+            self.buffer = bytearray(max(len(plaintext), 2 * len(self.buffer)))
+        ciphertext = memoryview(self.buffer)[:len(plaintext)]
+        with socket_lock(self.sock):
+            nonce, _, tag = seal(self.aes_key, plaintext, output=ciphertext)
+            length = AES_NONCE_SIZE + len(plaintext) + AES_TAG_SIZE
+            send_parts(self.sock, [length.to_bytes(4, "big"), nonce, ciphertext, tag])
+
+
+class LatestQueue:
+    """
+    Bounded hand-off between pipeline stages that only keeps the newest item per key.
+    Putting an item for a key that is still waiting replaces the old one, and when more
+    than maxsize keys are waiting the oldest is dropped; both count as drops.
+    get() returns (key, item), or None once the queue is closed and empty.
+    """
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.puts = 0
+        self.drops = 0
+
+    def put(self, key, item):
+        with self.cond:
+            if key in self.items:
+                del self.items[key]
+                self.drops += 1
+            self.items[key] = item
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+                self.drops += 1
+            self.puts += 1
+            self.cond.notify()
+
+    def get(self):
+        with self.cond:
+            while not self.items and not self.closed:
+                self.cond.wait()
+            if self.items:
+                return self.items.popitem(last=False)
+            return None
+
+    def close(self):
+        # Consumers finish what is queued, then get() returns None
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        with self.cond:
+            return {'depth': len(self.items), 'puts': self.puts, 'drops': self.drops}
+
+
+class Outbox:
+    """
+    Outbound queue and writer thread for one connection, so a slow client only ever
+    stalls its own writer. Messages go out in the order they were queued and are
+    encrypted by the writer. Video frames (send_frame) are best effort: when more than
+    max_frames are waiting the oldest frame is dropped. Control messages (send) are
+    never dropped. observe, if given, is called with the seconds each write took.
+    Subclasses can drain the queue some other way by overriding start() and wake().
+    """
+
+    def __init__(self, sock, aes_key, max_frames=2, observe=None):
+        self.sock = sock
+        self.aes_key = aes_key
+        self.max_frames = max_frames
+        self.items = collections.deque()   # (is_frame, plaintext)
+        self.frames = 0
+        self.queued_bytes = 0
+        self.cond = threading.Condition()
+        self.closed = False
+        self.error = None
+        self.sent = 0
+        self.dropped = 0
+        self.write_time = 0.0
+        self.observe = observe
+        self.frame_writer = FrameWriter(sock, aes_key)
+        self.writer = None
+        self.start()
+
+    def start(self):
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def wake(self):
+        # Called with cond held whenever there is something new for the writer
+        self.cond.notify()
+
+    def put(self, is_frame, plaintext):
+        with self.cond:
+            if self.closed or self.error is not None:
+                self.dropped += is_frame
+                return False
+            self.items.append((is_frame, plaintext))
+            self.queued_bytes += len(plaintext)
+            if is_frame:
+                self.frames += 1
+                if self.frames > self.max_frames:
+                    self.drop_oldest_frame()
+            self.wake()
+            return True
+
+    def drop_oldest_frame(self):
+        for i, (is_frame, plaintext) in enumerate(self.items):
+            if is_frame:
+                del self.items[i]
+                self.frames -= 1
+                self.queued_bytes -= len(plaintext)
+                self.dropped += 1
+                return
+
+    def send(self, plaintext):
+        return self.put(False, plaintext)
+
+    def send_frame(self, plaintext):
+        return self.put(True, plaintext)
+
+    def take(self):
+        # Next message to write, or None when nothing is queued
+        with self.cond:
+            if not self.items:
+                return None
+            is_frame, plaintext = self.items.popleft()
+            self.frames -= is_frame
+            self.queued_bytes -= len(plaintext)
+            return plaintext
+
+    def write_loop(self):
+        while True:
+            with self.cond:
+                while not self.items and not self.closed:
+                    self.cond.wait()
+            plaintext = self.take()
+            if plaintext is None:
+                return
+            start = time.perf_counter()
+            try:
+                self.frame_writer.write(plaintext)
+            except OSError as e:
+                self.failed(e)
+                return
+            self.wrote(time.perf_counter() - start)
+
+    def wrote(self, elapsed):
+        self.write_time += elapsed
+        self.sent += 1
+        if self.observe is not None:
+            self.observe(elapsed)
+
+    def failed(self, e):
+        with self.cond:
+            self.error = e
+            self.dropped += sum(frame for frame, _ in self.items)
+            self.items.clear()
+            self.frames = self.queued_bytes = 0
+        print("[Outbox] send failed, connection dropped:", e)
+
+    def close(self):
+        # The writer sends whatever is already queued, then exits
+        with self.cond:
+            self.closed = True
+            self.wake()
+
+    def join(self, timeout=None):
+        self.writer.join(timeout)
+
+    def stats(self):
+        with self.cond:
+            return {'queued': len(self.items), 'frames': self.frames, 'bytes': self.queued_bytes,
+                    'sent': self.sent, 'dropped': self.dropped, 'write_seconds': self.write_time,
+                    'failed': self.error is not None}
+
+
 def stack_frames(frames, grid_size=(2,3)):
     h, w = frames[0].shape[:2]
     blank = np.zeros_like(frames[0])
@@ -131,3 +459,51 @@ def stack_frames(frames, grid_size=(2,3)):
     for i in range(0, len(frames), grid_size[1]):
         rows.append(np.hstack(frames[i:i+grid_size[1]]))
     return np.vstack(rows)
+
+
+# JPEG DCT scaling: the decoder can skip detail and produce 1/2, 1/4 or 1/8 size directly
+REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def jpeg_size(data):
+    """
+    Returns (height, width) from the JPEG frame header without decoding, or None.
+    """
+    i, n = 2, len(data)
+    while i + 9 < n:
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            h = int.from_bytes(data[i + 5:i + 7], "big")
+            w = int.from_bytes(data[i + 7:i + 9], "big")
+            return h, w
+        if marker == 0xFF or marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2 if marker != 0xFF else 1   # markers without a length field
+            continue
+        i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+    return None
+
+
+def decode_frame(payload, min_side=0):
+    """
+    Decodes a JPEG at the smallest DCT scale whose long side is still >= min_side.
+    """
+    return decode_upload(payload, min_side)[0]
+
+
+def decode_upload(payload, min_side=0):
+    """
+    decode_frame, plus the factor it shrank the image by: uploaded pixels per decoded pixel.
+    """
+    arr = np.frombuffer(payload, np.uint8)
+    size = jpeg_size(payload) if min_side else None
+    if size is not None:
+        long_side = max(size)
+        for factor, flag in REDUCED_FLAGS:
+            if long_side // factor >= min_side:
+                frame = cv2.imdecode(arr, flag)
+                # The decoder rounds odd sizes up, so take the ratio from what came out
+                return frame, (size[1] / frame.shape[1] if frame is not None else 1.0)
+    return cv2.imdecode(arr, cv2.IMREAD_COLOR), 1.0
@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import argparse
+import threading
+import contextlib
+import Utils
+
+SIZES_KB = (10, 50, 100, 200)      # realistic JPEG frame sizes
+KEY = bytes(range(16))
+
+
+def rate(count, nbytes, elapsed):
+    return {'messages': count, 'seconds': elapsed, 'msgs_per_s': count / elapsed,
+            'mb_per_s': nbytes / elapsed / 2**20}
+
+
+def timed(fn, seconds):
+    # Calls fn() until `seconds` have passed; returns (calls, elapsed)
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        fn()
+        count += 1
+        now = time.perf_counter()
+        if now >= deadline:
+            return count, now - start
+
+
+def bench_crypto(size, seconds):
+    payload = os.urandom(size)
+    blob = Utils.aes_encrypt(KEY, payload)
+    count, elapsed = timed(lambda: Utils.aes_encrypt(KEY, payload), seconds)
+    encrypt = rate(count, count * size, elapsed)
+    count, elapsed = timed(lambda: Utils.aes_decrypt(KEY, blob), seconds)
+    decrypt = rate(count, count * size, elapsed)
+    return {'aes_encrypt': encrypt, 'aes_decrypt': decrypt}
+
+
+def pump(sock, message, count):
+    # Writer side of a socketpair: the same message `count` times
+    for _ in range(count):
+        sock.sendall(message)
+
+
+def bench_recv_all(size, seconds):
+    a, b = socket.socketpair()
+    payload = os.urandom(size)
+    count = calibrate(lambda: Utils.aes_encrypt(KEY, payload), seconds) * 4
+    writer = threading.Thread(target=pump, args=(a, payload, count), daemon=True)
+    start = time.perf_counter()
+    writer.start()
+    for _ in range(count):
+        Utils.recv_all(b, size)
+    elapsed = time.perf_counter() - start
+    writer.join()
+    a.close()
+    b.close()
+    return rate(count, count * size, elapsed)
+
+
+def sender(sock, payload, count):
+    for _ in range(count):
+        Utils.send_encrypted(sock, KEY, payload)
+
+
+def bench_round_trip(size, seconds):
+    # send_encrypted on one end of a socketpair, recv_encrypted on the other
+    a, b = socket.socketpair()
+    payload = os.urandom(size)
+    count = calibrate(lambda: Utils.aes_encrypt(KEY, payload), seconds)
+    writer = threading.Thread(target=sender, args=(a, payload, count), daemon=True)
+    start = time.perf_counter()
+    writer.start()
+    for _ in range(count):
+        Utils.recv_encrypted(b, KEY)
+    elapsed = time.perf_counter() - start
+    writer.join()
+    a.close()
+    b.close()
+    return rate(count, count * size, elapsed)
+
+
+def stream_sender(sock, payload, count):
+    writer = Utils.FrameWriter(sock, Utils.CryptoSession(KEY, server=True))
+    for _ in range(count):
+        writer.write(payload)
+
+
+def bench_frame_stream(size, seconds):
+    # The frame path: FrameWriter on one end, FrameReader on the other, both with counter-nonce sessions
+    a, b = socket.socketpair()
+    payload = os.urandom(size)
+    count = calibrate(lambda: Utils.aes_encrypt(KEY, payload), seconds)
+    writer = threading.Thread(target=stream_sender, args=(a, payload, count), daemon=True)
+    reader = Utils.FrameReader(b, Utils.CryptoSession(KEY, server=False))
+    start = time.perf_counter()
+    writer.start()
+    for _ in range(count):
+        reader.read()
+    elapsed = time.perf_counter() - start
+    writer.join()
+    a.close()
+    b.close()
+    return rate(count, count * size, elapsed)
+
+
+def bench_contention(threads, size, seconds):
+    """
+    `threads` senders, each on its own socketpair, all going through send_encrypted
+    and so through whatever lock it takes; receivers drain the other ends.
+    """
+    payload = os.urandom(size)
+    count = max(calibrate(lambda: Utils.aes_encrypt(KEY, payload), seconds) // threads, 1)
+    pairs = [socket.socketpair() for _ in range(threads)]
+    workers = []
+    for a, b in pairs:
+        workers.append(threading.Thread(target=sender, args=(a, payload, count), daemon=True))
+        workers.append(threading.Thread(target=lambda sock=b: [Utils.recv_encrypted(sock, KEY) for _ in range(count)],
+                                        daemon=True))
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    for a, b in pairs:
+        a.close()
+        b.close()
+    result = rate(count * threads, count * threads * size, elapsed)
+    result['threads'] = threads
+    return result
+
+
+def calibrate(fn, seconds):
+    # Messages that fit in roughly `seconds`, judged from the encryption cost alone
+    count, elapsed = timed(fn, min(seconds, 0.2))
+    return max(int(count * seconds / elapsed / 2), 10)
+
+
+def run(sizes_kb=SIZES_KB, seconds=1.0, threads=(1, 2, 4, 8)):
+    results = {'python': platform.python_version(), 'machine': platform.machine(), 'seconds': seconds,
+               'sizes': {}, 'contention': []}
+    # Anything recv_encrypted prints or logs is measured, but not shown
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for kb in sizes_kb:
+            size = kb * 1024
+            row = bench_crypto(size, seconds)
+            row['recv_all'] = bench_recv_all(size, seconds)
+            row['round_trip'] = bench_round_trip(size, seconds)
+            row['frame_stream'] = bench_frame_stream(size, seconds)
+            results['sizes'][str(kb)] = row
+        for count in threads:
+            results['contention'].append(bench_contention(count, 100 * 1024, seconds))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of Utils framing and crypto over a local socketpair")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES_KB), help="payload sizes in KB")
+    parser.add_argument("--seconds", type=float, default=1.0, help="approximate time per scenario")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8], help="sender counts for contention")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.seconds, args.threads)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+        for kb, row in results['sizes'].items():
+            print(f"{kb:>4} KB  encrypt {row['aes_encrypt']['mb_per_s']:8.1f} MB/s  "
+                  f"decrypt {row['aes_decrypt']['mb_per_s']:8.1f} MB/s  recv_all {row['recv_all']['mb_per_s']:8.1f} MB/s  "
+                  f"round trip {row['round_trip']['msgs_per_s']:8.1f} msg/s  "
+                  f"frame stream {row['frame_stream']['msgs_per_s']:8.1f} msg/s")
+        for row in results['contention']:
+            print(f"{row['threads']:>4} senders  {row['msgs_per_s']:8.1f} msg/s  {row['mb_per_s']:8.1f} MB/s")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
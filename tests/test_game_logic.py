@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("imutils")
+pytest.importorskip("deep_sort_realtime")
+
+import Detector
+from GameLogic import Game, MAX_STATIC_FRAMES
+
+
+class NoPlayers:
+    # Scheduler stand-in: every detector run finds nobody
+    def submit(self, frame):
+        return Detector.InferenceRequest.completed([])
+
+
+def scene(moved=False):
+    # A textured still frame; moved shifts a bright block far enough for the motion gate
+    frame = np.zeros((480, 640, 3), np.uint8)
+    frame[::16, :] = 80
+    x = 300 if moved else 100
+    frame[200:280, x:x + 80] = 255
+    return frame
+
+
+def serve(game, frame):
+    request = game.request_detections(frame)
+    game.update_values(frame, False, request, draw=False)
+    return game.timing['plan']
+
+
+def test_gate_skips_static_frames_at_interval_one():
+    game = Game(NoPlayers(), detect_interval=1, motion_threshold=0.002, tracker="iou")
+    # Registration frames are always detected
+    assert [serve(game, scene()) for _ in range(5)] == ['detect'] * 5
+    # Static frames reuse the last boxes until the gap reaches MAX_STATIC_FRAMES
+    plans = [serve(game, scene()) for _ in range(MAX_STATIC_FRAMES)]
+    assert plans == ['interpolate'] * (MAX_STATIC_FRAMES - 1) + ['detect']
+    assert game.stats()['skipped'] == MAX_STATIC_FRAMES - 1
+
+    # A light change is detected even though nothing moved
+    game.change_light()
+    assert serve(game, scene()) == 'detect'
+    assert serve(game, scene()) == 'interpolate'
+
+    # Motion is detected on every frame, as the interval asks
+    assert [serve(game, scene(moved=x % 2 == 0)) for x in range(4)] == ['detect'] * 4
+
+
+def test_interval_applies_to_moving_frames():
+    game = Game(NoPlayers(), detect_interval=3, motion_threshold=0.002, tracker="iou")
+    assert [serve(game, scene()) for _ in range(5)] == ['detect'] * 5
+    # Moving frames follow the interval instead of forcing a detection each
+    plans = [serve(game, scene(moved=x % 2 == 0)) for x in range(6)]
+    assert plans == ['interpolate', 'interpolate', 'detect'] * 2
+    assert game.stats()['skipped'] == 0
+
+    # Static frames also skip the detections the interval would have run
+    plans = [serve(game, scene()) for _ in range(MAX_STATIC_FRAMES)]
+    assert plans == ['interpolate'] * (MAX_STATIC_FRAMES - 1) + ['detect']
+    assert game.stats()['skipped'] > 0
+
+
+def test_interval_without_gate():
+    game = Game(NoPlayers(), detect_interval=3, motion_threshold=0, tracker="iou")
+    assert [serve(game, scene()) for _ in range(5)] == ['detect'] * 5
+    assert [serve(game, scene()) for _ in range(6)] == ['interpolate', 'interpolate', 'detect'] * 2
+    assert game.stats()['skipped'] == 0
+
+
+class OneBox:
+    # Scheduler stand-in: reports one person box, given in uploaded-frame pixels
+    def __init__(self, letterbox):
+        self.letterbox = letterbox
+        self.box = None
+        self.source_scale = 1.0
+
+    def submit(self, frame):
+        left, top = self.letterbox.pad
+        scale = self.letterbox.scale / self.source_scale
+        x1, y1, x2, y2 = self.box
+        return Detector.InferenceRequest.completed([(x1 * scale + left, y1 * scale + top,
+                                                     x2 * scale + left, y2 * scale + top, 0.9)])
+
+
+def survives_shift(h, w, shift):
+    # Upload JPEGs of a player who moves `shift` camera pixels during red light
+    import cv2
+    import Utils
+    game = Game(NoPlayers(), motion_threshold=0, tracker="iou")
+    game.scheduler = scheduler = OneBox(game.letterbox)
+    x = w // 4
+    for i in range(12):
+        if i == 8:
+            game.change_light()
+        if i == 10:
+            x += shift
+        image = np.zeros((h, w, 3), np.uint8)
+        image[::7] = 50
+        frame, source_scale = Utils.decode_upload(cv2.imencode('.jpg', image)[1].tobytes(), Detector.INPUT_SIZE)
+        game.letterbox.fit(frame)
+        scheduler.source_scale = source_scale
+        scheduler.box = (x, h // 4, x + w // 8, h * 3 // 4)
+        game.update_values(frame, False, game.request_detections(frame), draw=False, source_scale=source_scale)
+    return bool(game.players.players['alive'][0])
+
+
+@pytest.mark.parametrize("h, w", [(480, 640), (720, 1280), (1080, 1920)])
+def test_move_tolerance_in_uploaded_pixels(h, w):
+    # HD uploads are decoded at reduced size; the tolerance still counts camera pixels
+    assert survives_shift(h, w, 4)
+    assert not survives_shift(h, w, 8)
@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("cv2")
+
+import InferenceService
+
+
+def test_dead_worker_fails_requests_and_is_replaced():
+    # Weights that cannot load: the worker exits before taking any frame
+    service = InferenceService.InferenceService(workers=1, weights="missing.onnx", backend="opencv", slots=2)
+    try:
+        request = service.submit(np.zeros((64, 64, 3), np.uint8))
+        with pytest.raises(RuntimeError):
+            request.result(timeout=30)
+        assert service.restarts >= 1
+        assert service.workers[0]['free'] and not service.workers[0]['inflight']
+    finally:
+        service.close()
@@ -0,0 +1,17 @@
+import Metrics
+
+
+def test_forget_drops_a_player_then_the_room():
+    Metrics.uploads.inc("room1", "alice")
+    Metrics.uploads.inc("room1", "bob")
+    Metrics.stage_seconds.observe(0.01, "room1", "alice", "decode")
+    Metrics.uploads.inc("room2", "alice")
+
+    Metrics.forget("room1", "alice")
+    assert [values for values, _ in Metrics.uploads.items() if values[0] == "room1"] == [("room1", "bob")]
+    assert not [values for values, _ in Metrics.stage_seconds.items() if values[:2] == ("room1", "alice")]
+
+    Metrics.forget("room1")
+    assert [values for values, _ in Metrics.uploads.items() if values[0] != "room2"] == []
+    assert ("room2", "alice") in dict(Metrics.uploads.items())
+    assert 'room="room1"' not in Metrics.registry.render()
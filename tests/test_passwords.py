@@ -0,0 +1,22 @@
+import os
+import signal
+import pytest
+
+pytest.importorskip("bcrypt")
+
+import Passwords
+
+
+def test_dead_worker_does_not_break_logins():
+    hasher = Passwords.PasswordHasher(workers=1, max_queued=2, rounds=4)
+    try:
+        pw_hash = hasher.hash(b"secret")
+        broken = hasher.pool
+        for pid in list(broken._processes):
+            os.kill(pid, signal.SIGKILL)
+        # The pool is rebuilt and the check retried, not failed
+        assert hasher.check(b"secret", pw_hash) == (True, None)
+        assert hasher.pool is not broken
+        assert hasher.check(b"wrong", pw_hash) == (False, None)
+    finally:
+        hasher.close()
@@ -0,0 +1,46 @@
+import RateControl
+
+
+def interval(rate, now, uploads, frame_bytes, frame_seconds=0.005, starved_ticks=0, ticks=20):
+    # One INTERVAL of measurements, then the controller's decision
+    for _ in range(uploads):
+        rate.observe_upload(frame_bytes)
+        rate.observe_frame(frame_seconds)
+    for i in range(ticks):
+        rate.observe_tick(i < starved_ticks)
+    return rate.update(now, 0, 0)
+
+
+def settle(rate, now):
+    # The interval after a change is skipped while the client switches
+    rate.update(now, 0, 0)
+
+
+def test_slow_camera_keeps_quality():
+    rate = RateControl.RateController(15, 30)
+    rate.update(0.0, 0, 0)
+    # Full link at 15 fps first, then the camera only delivers 8 small frames a second
+    assert interval(rate, 1.0, 15, 20000) is None
+    fps, quality = interval(rate, 2.0, 8, 20000)
+    assert (fps, quality) == (8, 30)
+
+
+def test_full_link_lowers_quality():
+    rate = RateControl.RateController(15, 30)
+    rate.update(0.0, 0, 0)
+    interval(rate, 1.0, 15, 20000)
+    # Same bytes per second, but fewer frames get through: the link is the limit
+    fps, quality = interval(rate, 2.0, 10, 30000)
+    assert fps == 15 and quality < 30
+
+
+def test_processing_time_caps_fps():
+    rate = RateControl.RateController(15, 30)
+    rate.update(0.0, 0, 0)
+    # 125 ms of game loop per frame: only PROCESS_BUDGET / 0.125 frames a second fit
+    fps, quality = interval(rate, 1.0, 15, 20000, frame_seconds=0.125)
+    assert fps == int(RateControl.PROCESS_BUDGET / 0.125)
+    settle(rate, 2.0)
+    # Uploads keep pace, yet the rate is not raised past the budget
+    assert interval(rate, 3.0, fps, 20000, frame_seconds=0.125) in (None, (fps, 30))
+    assert rate.fps == fps
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("cv2")
+
+from Tracking import IouTrack
+
+
+def test_velocity_under_constant_motion():
+    track = IouTrack("1", [100, 100, 50, 100], 0.9, n_init=1)
+    for step in range(1, 6):
+        track.predict()
+        track.update([100 + 4 * step, 100, 50, 100], 0.9)
+        assert np.allclose(track.velocity, [4, 0])
+
+
+def test_velocity_after_coasting():
+    track = IouTrack("1", [100, 100, 50, 100], 0.9, n_init=1)
+    track.predict()
+    track.predict()
+    track.update([110, 100, 50, 100], 0.9)
+    assert np.allclose(track.velocity, [5, 0])